@@ -37,95 +37,898 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 bbpystepper is a Python module used to control a stepper motor via the 
 BeagleBone
+
+Moves can be made at a constant speed, or with an acceleration limit (and
+optionally a jerk limit) using plan_move(), which returns the time between
+each step of a trapezoidal / S-curve speed profile:
+
+    stepper.rotate(degrees=360, rpm=40, accel=60, jerk=600)
+
+    rpm    - peak (cruise) speed in rev/min
+    accel  - acceleration limit in rpm per second
+    jerk   - jerk limit in rpm per second^2 (None for a trapezoidal profile)
+
+Each step is issued at an absolute deadline on the monotonic clock, so 
+GPIO write time and late wakeups do not add up over a move.  The error of
+every step against its deadline is kept in stepper.step_errors and 
+summarized by stepper.move_stats().
+
+The coils are driven from a phase table selected with 
+stepper.set_drive_mode():
+
+    "wave"   - one coil at a time (4 phases)
+    "full"   - two coils at a time (4 phases, default)
+    "half"   - alternating one / two coils (8 phases, double resolution)
+    "micro"  - sine / cosine PWM duties (4 * MICROSTEPS phases; needs
+               gpio_backend=gpio_bank.BACKEND_PWM and PWM capable pins)
+
+steps_per_rev is always given in full steps; moves are made in steps of 
+the current mode.
+
+The position is kept as an exact integer step count (stepper.position); 
+stepper.angle is derived from it.  rotate() moves relative to the angle 
+commanded so far, rounding to the nearest step once, so many small moves do
+not drift.  move_to(angle) takes the shortest way to an absolute angle.
+
+home() finds the hall effect sensor: a fast seek until the sensor 
+triggers, a back off until the sensor clears, then a slow approach to 
+find the edge precisely.  Position 0 is set home_offset degrees past that edge.  Once 
+homed, go_to_initial_position() just moves back to position 0; it only 
+searches if the motor has not been homed.  home() raises HomingError if 
+the sensor is not found (or does not clear) within one search or the 
+timeout, or if reading the sensor fails.  With 
+hall_interrupt_pin set, the sensor's INT output is watched by an edge 
+event thread (gpio_events), so checking the sensor during a move costs no
+bus read.
+
+With stall_detection=True, a homed stepper samples the hall effect sensor
+during moves.  The sensor edge found by home() should be crossed at the 
+same step position on every revolution (entering it moving forwards, 
+leaving it moving backwards).  When it is crossed somewhere else, the 
+difference is the number of missed steps.  Small errors (up to 
+STALL_REHOME_STEPS) are corrected by fixing the position count; larger ones 
+re-home the motor at the end of the move and then finish the move.  See 
+stepper.stall for the errors seen.
+
+rotate_async() and move_to_async() run the move on the stepper's own 
+motion thread and return a concurrent.futures.Future, so the caller can do
+other work (e.g. wait for the DC motor) while the motor turns.  Moves 
+queue up in order.  cleanup() waits for queued moves and releases the pins.
+
+Thread safety: moves (rotate, move_to, move_steps, home) are serialized by
+stepper.move_lock, so two threads can never interleave steps.  Position and
+phase are updated together under stepper.state_lock after every step, and 
+status() returns a consistent snapshot of them from any thread, including 
+while a move is running.  The pin list passed in is copied and never 
+modified; direction is handled by walking the phase table backwards.
+
+MultiAxis drives several steppers from one timing loop, e.g. the turret 
+and the card chute tilt.  The axis with the most steps sets the step 
+timing; the other axes step on the same ticks, spread out Bresenham style,
+so all axes start and finish together:
+
+    axes = MultiAxis([turret, chute])
+    axes.rotate([90, -15], rpm=20, accel=60)
+
+A synchronized move takes as long as its longest axis rather than the sum
+of the moves made one after another.
+
+Coil patterns are written with gpio_bank, which sets all four pins with one
+clear and one set register write per GPIO bank (falling back to one 
+Adafruit_BBIO call per pin when /dev/mem cannot be mapped).
 """
 
 from __future__ import division
 import Adafruit_BBIO.GPIO as GPIO
 import time
 import math
+import functools
+import threading
+import contextlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
+import gpio_bank
 import hall_effect_sensor as hall
 
+# Time step used to integrate the acceleration ramp
+RAMP_TIME_STEP = 0.0001
+
+# Number of move plans / ramps kept in the cache
+PLAN_CACHE_SIZE = 32
+
+# Time before a step deadline spent spinning instead of sleeping (s)
+SPIN_TIME = 0.0002
+
+# Homing
+HOME_FAST_RPM = 15
+HOME_SLOW_RPM = 2
+HOME_BACKOFF_DEGREES = 10.0
+HOME_SEARCH_REVS = 1.25
+HOME_TIMEOUT = 15.0
+
+
+# Stall / missed step detection
+STALL_SAMPLE_STEPS = 2          # Steps between hall effect sensor reads
+STALL_TOLERANCE_STEPS = 2       # Edge error treated as sensor hysteresis
+STALL_REHOME_STEPS = 32         # Edge error above which the motor re-homes
+
+
+class HomingError(Exception):
+    """Raised when the hall effect sensor cannot be found"""
+    pass
+
+
+class StallDetector(object):
+    """Checks hall effect sensor crossings against the expected step position"""
+    def __init__(self, stepper, tolerance=STALL_TOLERANCE_STEPS,
+                 rehome=STALL_REHOME_STEPS, sample_steps=STALL_SAMPLE_STEPS):
+        self.stepper = stepper
+        self.tolerance = tolerance
+        self.rehome = rehome
+        self.sample_steps = sample_steps
+        
+        self.last_state = None
+        self.rehome_needed = False
+        
+        # (position, error) of every crossing seen, and how they were handled
+        self.crossings = []
+        self.last_error = 0
+        self.corrections = 0
+        self.rehomes = 0
+    
+    def start(self):
+        """Reads the sensor at the start of a move"""
+        self.last_state = self.stepper.sensor.in_position()
+    
+    def check(self, direction):
+        """Reads the sensor; compares an edge crossing with the expected one"""
+        state = self.stepper.sensor.in_position()
+        last = self.last_state
+        self.last_state = state
+        
+        # The home edge is entered moving forwards and left moving backwards
+        if direction > 0:
+            crossed = state and not last
+        else:
+            crossed = last and not state
+        
+        if not crossed:
+            return
+        
+        stepper = self.stepper
+        steps_per_rev = stepper.mode_steps_per_rev()
+        
+        # When moving backwards the edge is seen one step after it is left
+        observed = stepper.position if direction > 0 else stepper.position + 1
+        error = (observed - stepper.home_edge()) % steps_per_rev
+        
+        if error > steps_per_rev // 2:
+            error -= steps_per_rev
+        
+        self.crossings.append((stepper.position, error))
+        self.last_error = error
+        
+        if abs(error) <= self.tolerance:
+            return
+        
+        if abs(error) <= self.rehome:
+            # The motor is at the edge; the count drifted by error steps
+            with stepper.state_lock:
+                stepper.position -= error
+            self.corrections += 1
+        else:
+            self.rehome_needed = True
+
+
+class PhaseSequencer(object):
+    """Walks a phase table forwards or backwards from the current phase
+    
+    The next phase in each direction is precomputed, so a step is a single
+    index lookup and the pin order never has to change.
+    """
+    def __init__(self, table, phase=0):
+        self.table = table
+        self.phase = phase
+        
+        count = len(table)
+        self.forward = tuple((i + 1) % count for i in range(count))
+        self.backward = tuple((i - 1) % count for i in range(count))
+    
+    def successors(self, direction):
+        """Returns the table of next phases for a direction (+1 / -1)"""
+        if direction > 0:
+            return self.forward
+        return self.backward
+
+
 def initialize_pins(pins):
     for pin in pins:
         GPIO.setup(pin, GPIO.OUT)
 
-def set_all_pins_low(pins):
-    for pin in pins:
-        GPIO.output(pin, GPIO.LOW)
+def microstep_table(microsteps):
+    """Returns the PWM phase table with microsteps phases per full step
+    
+    Each coil's duty follows a clipped cosine of the electrical angle, 
+    starting with coils 0 and 3 equally on, the same position as FULL_TABLE[0].
+    """
+    table = []
+    
+    for phase in range(4 * microsteps):
+        angle = math.pi / 2.0 * (phase / microsteps - 0.5)
+        table.append(tuple(round(max(0.0, math.cos(angle - coil * math.pi / 2.0)), 3)
+                           for coil in range(4)))
+    
+    return tuple(table)
+
+OFF_PATTERN = (0, 0, 0, 0)
+
+# Coil states indexed by phase; coils are in pin order
+WAVE_TABLE = ((1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1))
+
+FULL_TABLE = ((1, 0, 0, 1), (1, 1, 0, 0), (0, 1, 1, 0), (0, 0, 1, 1))
+
+HALF_TABLE = ((1, 0, 0, 1), (1, 0, 0, 0), (1, 1, 0, 0), (0, 1, 0, 0),
+              (0, 1, 1, 0), (0, 0, 1, 0), (0, 0, 1, 1), (0, 0, 0, 1))
+
+# PWM microsteps per full step
+MICROSTEPS = 8
+
+DRIVE_MODES = {"wave"  : WAVE_TABLE,
+               "full"  : FULL_TABLE,
+               "half"  : HALF_TABLE,
+               "micro" : microstep_table(MICROSTEPS)}
+
+
+def wait_until(deadline):
+    """Waits until deadline (time.monotonic()); returns the time reached
+    
+    Sleeps until SPIN_TIME before the deadline and spins for the rest, 
+    since sleep() alone can wake up late by more than a step period.
+    """
+    while True:
+        now = time.monotonic()
+        remaining = deadline - now
+        
+        if remaining <= 0:
+            return now
         
-def wavedrive(pins, pin_index):
-    for i in range(len(pins)):
-        if i == pin_index:
-            GPIO.output(pins[i], GPIO.HIGH)
+        if remaining > SPIN_TIME:
+            time.sleep(remaining - SPIN_TIME)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def plan_ramp(max_rpm, accel, jerk=None, steps_per_rev=2048.0):
+    """Returns the step intervals (s) to accelerate from rest to max_rpm
+    
+    The speed profile is integrated in small time steps and the time at 
+    which each whole step is crossed is recorded.  With a jerk limit the
+    acceleration builds up and dies down linearly (S-curve); without one it
+    jumps straight to accel (trapezoid).  Ramps are cached, so treat the 
+    returned array as read only.
+    """
+    if (max_rpm <= 0) or (accel <= 0) or ((jerk is not None) and (jerk <= 0)):
+        raise ValueError("rpm, accel and jerk must be greater than 0")
+    
+    # Convert to steps/s, steps/s^2, steps/s^3
+    v_max = max_rpm * steps_per_rev / 60.0
+    a_max = accel * steps_per_rev / 60.0
+    
+    if jerk is None:
+        j_max = None
+    else:
+        j_max = jerk * steps_per_rev / 60.0
+    
+    dt        = RAMP_TIME_STEP
+    t         = 0.0
+    v         = 0.0
+    a         = 0.0
+    position  = 0.0
+    last_time = 0.0
+    intervals = array('d')
+    
+    while v < v_max:
+        if j_max is None:
+            a = a_max
         else:
-            GPIO.output(pins[i], GPIO.LOW)
+            # Speed gained while the acceleration ramps back down to zero
+            v_ramp_down = a * a / (2.0 * j_max)
+            
+            if v + v_ramp_down >= v_max:
+                a = max(a - j_max * dt, j_max * dt)
+            else:
+                a = min(a + j_max * dt, a_max)
+        
+        v_next   = min(v + a * dt, v_max)
+        next_pos = position + 0.5 * (v + v_next) * dt
+        
+        # Record the (interpolated) time of each whole step crossed
+        while math.floor(next_pos) > len(intervals):
+            step_pos  = len(intervals) + 1
+            step_time = t + dt * (step_pos - position) / (next_pos - position)
+            intervals.append(step_time - last_time)
+            last_time = step_time
+        
+        position = next_pos
+        v        = v_next
+        t        = t + dt
+    
+    return intervals
 
-def fullstep(pins, pin_index):
-    """pin_index is the lead pin"""
-    GPIO.output(pins[pin_index], GPIO.HIGH)
-    GPIO.output(pins[(pin_index+3) % 4], GPIO.HIGH)
-    GPIO.output(pins[(pin_index+1) % 4], GPIO.LOW)
-    GPIO.output(pins[(pin_index+2) % 4], GPIO.LOW)
+# End def
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def plan_move(steps, max_rpm, accel, jerk=None, steps_per_rev=2048.0):
+    """Returns the interval (s) before each of steps steps of a move
+    
+    The move accelerates with plan_ramp(), cruises at max_rpm and 
+    decelerates with the mirror image of the ramp.  Moves too short to 
+    reach max_rpm use the first half of the ramp.  Plans are cached per 
+    move length, so treat the returned array as read only.
+    """
+    ramp   = plan_ramp(max_rpm, accel, jerk, steps_per_rev)
+    cruise = 60.0 / (steps_per_rev * max_rpm)
+    
+    if steps >= 2 * len(ramp):
+        intervals = array('d', ramp)
+        intervals.extend(array('d', [cruise]) * (steps - 2 * len(ramp)))
+    else:
+        half = steps // 2
+        intervals = ramp[:half]
+        
+        if steps % 2:
+            intervals.append(ramp[half])
+        
+        ramp = ramp[:half]
+    
+    # Decelerate: the time between steps grows back in reverse order.  The
+    # interval before a step is set by the speed of the step before it.
+    intervals.extend(ramp[::-1])
+    
+    return intervals
+
+# End def
 
 
 class Stepper(object):
     def __init__(self, steps_per_rev=2048.0,
-                 pins=["P8_13", "P8_14", "P8_15", "P8_16"],
-                 hall_effect_bus=1, hall_effect_address = 0x60):
+                 pins=("P8_13", "P8_14", "P8_15", "P8_16"),
+                 hall_effect_bus=1, hall_effect_address = 0x60,
+                 hall_effect_backend=hall.BACKEND_I2C, hall_interrupt_pin=None,
+                 events=None,
+                 gpio_backend=gpio_bank.BACKEND_MMAP, drive_mode="full",
+                 home_offset=0.0, stall_detection=False):
 
-        self.pins = pins
+        # Copy the pins so the caller's list is never shared or modified
+        self.pins = tuple(pins)
         
         initialize_pins(self.pins)
-        set_all_pins_low(self.pins)
         
-        self.angle = 0
+        # move_lock serializes moves; state_lock guards position / phase
+        self.move_lock = threading.RLock()
+        self.state_lock = threading.Lock()
+        self.moving = False
+        self.direction = 1
+        
+        # Write whole coil patterns at once
+        self.coils = gpio_bank.open_pins(self.pins, gpio_backend)
+        self.coils.write(OFF_PATTERN)
+        
         self.steps_per_rev = steps_per_rev
         
+        # Position in steps of the current drive mode, and the angle (in 
+        # degrees, not wrapped) that moves have asked for so far
+        self.position = 0
+        self.target = 0.0
+        
+        # Angle of position 0 past the hall effect sensor edge
+        self.home_offset = home_offset
+        self.homed = False
+        
         # Initialize stepping mode
-        self.drivemode = fullstep
+        self.sequencer = PhaseSequencer(FULL_TABLE)
+        self.set_drive_mode(drive_mode)
         
         # Hall Effect Sensor
-        self.sensor = hall.HallEffectSensor(hall_effect_bus = 1, hall_effect_address = 0x60)
+        self.sensor = hall.HallEffectSensor(hall_effect_bus = hall_effect_bus, 
+                                            hall_effect_address = hall_effect_address,
+                                            backend = hall_effect_backend,
+                                            interrupt_pin = hall_interrupt_pin,
+                                            events = events)
+        
+        # Timing of the last move
+        self.step_errors = array('d')
+        self.move_time = 0.0
         
+        # Missed step detection
+        self.stall = None
+        self.recovering = False
+        
+        if stall_detection:
+            self.stall = StallDetector(self)
+        
+        # Motion thread for rotate_async() / move_to_async()
+        self.motion = ThreadPoolExecutor(max_workers=1)
+        
+    
+    def set_drive_mode(self, mode):
+        """Selects the phase table used to drive the coils ("wave", "full", 
+        "half" or "micro") """
+        if mode not in DRIVE_MODES:
+            raise ValueError("Unknown drive mode {0}".format(mode))
+        
+        table = DRIVE_MODES[mode]
+        
+        if any(state not in (0, 1) for pattern in table for state in pattern) \
+           and not self.coils.pwm:
+            raise ValueError("Drive mode {0} needs PWM outputs".format(mode))
+        
+        with self.move_lock:
+            with self.state_lock:
+                # Keep the rotor where it is: same fraction of the electrical cycle
+                old = len(self.sequencer.table)
+                phase = self.sequencer.phase * len(table) // old
+                
+                self.sequencer = PhaseSequencer(table, phase)
+                self.position = self.position * len(table) // old
+                self.drive_mode = mode
+    
+    def step_scale(self):
+        """Returns the number of steps of the current mode per full step"""
+        return len(self.sequencer.table) / 4.0
+    
+    def mode_steps_per_rev(self):
+        """Returns the number of steps of the current mode per revolution"""
+        return int(round(self.steps_per_rev * self.step_scale()))
+    
+    def home_edge(self):
+        """Returns the step position of the hall effect sensor edge"""
+        return -int(round(self.home_offset * self.mode_steps_per_rev() / 360.0))
+    
+    @property
+    def angle(self):
+        """Angle (0 - 360) computed from the integer step position"""
+        steps_per_rev = self.mode_steps_per_rev()
+        return (self.position % steps_per_rev) * 360.0 / steps_per_rev
     
-    def rotate(self, degrees=360, rpm=15):
-        """Rotates the stepper motor a specific number of degrees at a specified rpm """
-        step = 0
+    def status(self):
+        """Returns a consistent snapshot of the motor state; safe to call
+        from any thread, including during a move """
+        with self.state_lock:
+            steps_per_rev = self.mode_steps_per_rev()
+            
+            return {"position"   : self.position,
+                    "angle"      : (self.position % steps_per_rev) * 360.0 / steps_per_rev,
+                    "phase"      : self.sequencer.phase,
+                    "target"     : self.target,
+                    "moving"     : self.moving,
+                    "direction"  : self.direction,
+                    "drive_mode" : self.drive_mode,
+                    "homed"      : self.homed}
+    
+    def rotate(self, degrees=360, rpm=15, accel=None, jerk=None):
+        """Rotates the stepper motor a specific number of degrees at a specified rpm 
+        
+        If accel (rpm/s) is given, the motor accelerates up to rpm and back
+        down using plan_move(); jerk (rpm/s^2) smooths the ramps further.
+        """
+        with self.move_lock:
+            steps_per_rev = self.mode_steps_per_rev()
+            
+            # Round the total commanded angle, not each move, so rounding 
+            # errors do not build up
+            self.target += degrees
+            goal = int(round(self.target * steps_per_rev / 360.0))
+            
+            self.move_steps(goal - self.position, rpm, accel, jerk)
+    
+    def move_to(self, angle, rpm=15, accel=None, jerk=None):
+        """Moves to an absolute angle (degrees) the shortest way round"""
+        with self.move_lock:
+            steps_per_rev = self.mode_steps_per_rev()
+            
+            goal  = int(round((angle % 360.0) * steps_per_rev / 360.0))
+            delta = (goal - self.position) % steps_per_rev
+            
+            if delta > steps_per_rev // 2:
+                delta -= steps_per_rev
+            
+            self.target = (self.position + delta) * 360.0 / steps_per_rev
+            
+            self.move_steps(delta, rpm, accel, jerk)
+    
+    def rotate_async(self, degrees=360, rpm=15, accel=None, jerk=None):
+        """Queues rotate() on the motion thread; returns a Future"""
+        return self.motion.submit(self.rotate, degrees, rpm, accel, jerk)
+    
+    def move_to_async(self, angle, rpm=15, accel=None, jerk=None):
+        """Queues move_to() on the motion thread; returns a Future"""
+        return self.motion.submit(self.move_to, angle, rpm, accel, jerk)
+    
+    def move_steps(self, steps, rpm=15, accel=None, jerk=None, until=None):
+        """Moves exactly steps steps (negative for reverse) of the current mode
+        
+        If until is given, it is called after every step and the move stops
+        early when it returns True.  Returns the number of steps taken.
+        """
+        with self.move_lock:
+            self.moving = True
+            
+            try:
+                return self._move_steps(steps, rpm, accel, jerk, until)
+            finally:
+                self.moving = False
+    
+    def _move_steps(self, steps, rpm, accel, jerk, until):
+        """Stepping loop for move_steps(); called with move_lock held"""
+        steps_per_rev = self.mode_steps_per_rev()
         
         # Calculate time between steps in seconds
-        wait_time = 60.0/(self.steps_per_rev*rpm)
+        wait_time = 60.0/(steps_per_rev*rpm)
         
-        # Convert degrees to steps
-        steps = math.fabs(degrees*self.steps_per_rev/360.0)
-        self.direction = 1
+        count = abs(int(steps))
+        direction = -1 if steps < 0 else 1
+        
+        if accel is None:
+            intervals = array('d', [wait_time]) * count
+        else:
+            intervals = plan_move(count, rpm, accel, jerk, steps_per_rev)
         
-        if degrees < 0:
-            self.pins.reverse()
-            self.direction = -1
+        # Preallocate the timing record so the step loop does not allocate
+        errors = array('d', [0.0]) * count
+        self.step_errors = errors
         
-        while step < steps:
-            for pin_index in range(len(self.pins)):
-                self.drivemode(self.pins, pin_index)
-                time.sleep(wait_time)
-                step += 1
-                self.angle = (self.angle + self.direction/self.steps_per_rev \
-                *360.0) % 360.0
+        sequencer = self.sequencer
+        table = sequencer.table
+        next_phase = sequencer.successors(direction)
+        state_lock = self.state_lock
         
-        if degrees < 0:
-            self.pins.reverse()
-    	
-        set_all_pins_low(self.pins)
+        with state_lock:
+            self.direction = direction
         
+        # Only check for missed steps once the edge position is known
+        stall = self.stall if self.homed else None
+        
+        if stall is not None:
+            stall.start()
+            sample_steps = stall.sample_steps
+        
+        start = time.monotonic()
+        deadline = start
+        
+        taken = 0
+        
+        # The coils are always switched off, even if a sensor read in 
+        # until() or the stall check raises
+        try:
+            for step in range(count):
+                # Walk the phase table forwards or backwards; the pins never move
+                phase = next_phase[sequencer.phase]
+                
+                now = wait_until(deadline)
+                self.coils.write(table[phase])
+                
+                # Phase and position always change together
+                with state_lock:
+                    sequencer.phase = phase
+                    self.position += direction
+                
+                errors[step] = now - deadline
+                
+                # The next deadline comes from the plan, not from when this step
+                # actually happened, so overshoot is made up on the next step
+                deadline += intervals[step]
+                taken += 1
+                
+                if (stall is not None) and (taken % sample_steps == 0):
+                    stall.check(direction)
+                
+                if (until is not None) and until():
+                    break
+            
+            # Hold the last step for its full interval
+            self.move_time = wait_until(deadline) - start
+        finally:
+            self.coils.write(OFF_PATTERN)
+            
+            if taken < count:
+                self.step_errors = errors[:taken]
+        
+        if (stall is not None) and stall.rehome_needed and not self.recovering:
+            self._recover()
+        
+        return taken
+    
+    def _recover(self):
+        """Re-homes after a large missed step error; then finishes the move"""
+        target = self.target
+        
+        self.stall.rehome_needed = False
+        self.stall.rehomes += 1
+        self.recovering = True
+        
+        try:
+            self.home()
+            self.move_to(target % 360.0)
+        finally:
+            self.recovering = False
+        
+    def move_stats(self):
+        """Returns the achieved step rate and timing error of the last move
+        
+        step_rate is in steps/s; errors are the lateness of each step 
+        against its deadline, in seconds.
+        """
+        errors = self.step_errors
+        count  = len(errors)
+        
+        if count == 0:
+            return {"steps": 0, "step_rate": 0.0, "mean_error": 0.0,
+                    "max_error": 0.0, "jitter": 0.0}
+        
+        mean = sum(errors) / count
+        
+        return {"steps"      : count,
+                "step_rate"  : count / self.move_time,
+                "mean_error" : mean,
+                "max_error"  : max(errors),
+                "jitter"     : math.sqrt(sum((e - mean) ** 2 for e in errors) / count)}
+    
     def zero_angle(self):
-        self.angle = 0
+        with self.state_lock:
+            self.position = 0
+            self.target = 0.0
+    
+    def cleanup(self):
+        """Waits for queued moves; turns the coils off and releases the pins"""
+        self.motion.shutdown(wait=True)
+        self.coils.write(OFF_PATTERN)
+        self.coils.close()
+        self.sensor.cleanup()
+        
+        
+    def home(self, timeout=HOME_TIMEOUT, fast_rpm=HOME_FAST_RPM, slow_rpm=HOME_SLOW_RPM):
+        """ Finds the hall effect sensor and sets position 0 home_offset past it """
+        with self.move_lock:
+            try:
+                self._home(timeout, fast_rpm, slow_rpm)
+            except (OSError, IOError) as error:
+                # A failed sensor read means the edge was not found
+                self.homed = False
+                raise HomingError("Hall effect sensor read failed ({0})".format(error))
+    
+    def _home(self, timeout, fast_rpm, slow_rpm):
+        """Homing sequence for home(); called with move_lock held"""
+        steps_per_rev = self.mode_steps_per_rev()
+        search  = int(steps_per_rev * HOME_SEARCH_REVS)
+        backoff = int(round(HOME_BACKOFF_DEGREES * steps_per_rev / 360.0))
+        end     = time.monotonic() + timeout
+        edges   = []
+        
+        def found():
+            if self.sensor.in_position():
+                edges.append(self.position)
+                return True
+            return time.monotonic() > end
+        
+        def cleared():
+            return (not self.sensor.in_position()) or (time.monotonic() > end)
         
+        self.homed = False
         
-    def go_to_initial_position(self):
-        """ rotates stepper motor until initial position (determined by hall effect sensor) is reached """
-        while(self.sensor.in_position() == 0):
-            print("rotating motor")
-            time.sleep(0.05)
+        # Fast seek towards the magnet (skipped if already on it)
+        if not self.sensor.in_position():
+            self.move_steps(search, fast_rpm, until=found)
+        
+            if not edges:
+                raise HomingError("Hall effect sensor not found")
+        
+        # Back off until the sensor clears (however deep in the active zone
+        # the motor started), then approach slowly to find the edge
+        del edges[:]
+        
+        self.move_steps(-search, fast_rpm, until=cleared)
+        
+        if self.sensor.in_position():
+            if time.monotonic() > end:
+                raise HomingError("Homing timed out after {0} s".format(timeout))
+            
+            raise HomingError("Hall effect sensor did not clear")
+        
+        self.move_steps(2 * backoff, slow_rpm, until=found)
+        
+        if not edges:
+            if time.monotonic() > end:
+                raise HomingError("Homing timed out after {0} s".format(timeout))
+            
+            raise HomingError("Hall effect sensor edge not found")
+        
+        # The edge is home_offset before position 0
+        with self.state_lock:
+            self.position = self.home_edge()
+            self.target = self.position * 360.0 / steps_per_rev
+        self.homed = True
+        
+        self.move_to(0, fast_rpm)
+    
+    def go_to_initial_position(self, rpm=15, accel=None):
+        """ Moves to the initial position (determined by hall effect sensor)
+        
+        The first call homes the motor; after that the step position is 
+        known, so this is a direct move back to position 0.
+        """
+        if not self.homed:
+            self.home()
+        else:
+            self.move_to(0, rpm, accel)
+
+
+class MultiAxis(object):
+    """Moves several steppers together on one timing loop"""
+    def __init__(self, steppers):
+        self.steppers = tuple(steppers)
+        
+        if not self.steppers:
+            raise ValueError("MultiAxis needs at least one stepper")
+        
+        # Timing of the last move (ticks of the longest axis)
+        self.step_errors = array('d')
+        self.move_time = 0.0
+        
+        # Motion thread for rotate_async() / move_to_async()
+        self.motion = ThreadPoolExecutor(max_workers=1)
+    
+    def rotate(self, degrees, rpm=15, accel=None, jerk=None):
+        """Rotates each stepper by its entry in degrees; all finish together
+        
+        rpm / accel / jerk apply to the axis with the most steps.
+        """
+        if len(degrees) != len(self.steppers):
+            raise ValueError("Need one angle per stepper")
+        
+        with self._locked():
+            steps = []
+            
+            for stepper, angle in zip(self.steppers, degrees):
+                steps_per_rev = stepper.mode_steps_per_rev()
+                
+                # Same rounding of the total commanded angle as Stepper.rotate()
+                stepper.target += angle
+                goal = int(round(stepper.target * steps_per_rev / 360.0))
+                steps.append(goal - stepper.position)
+            
+            return self._move_steps(steps, rpm, accel, jerk)
+    
+    def move_to(self, angles, rpm=15, accel=None, jerk=None):
+        """Moves each stepper the shortest way to its entry in angles"""
+        if len(angles) != len(self.steppers):
+            raise ValueError("Need one angle per stepper")
+        
+        with self._locked():
+            steps = []
+            
+            for stepper, angle in zip(self.steppers, angles):
+                steps_per_rev = stepper.mode_steps_per_rev()
+                
+                goal  = int(round((angle % 360.0) * steps_per_rev / 360.0))
+                delta = (goal - stepper.position) % steps_per_rev
+                
+                if delta > steps_per_rev // 2:
+                    delta -= steps_per_rev
+                
+                stepper.target = (stepper.position + delta) * 360.0 / steps_per_rev
+                steps.append(delta)
+            
+            return self._move_steps(steps, rpm, accel, jerk)
+    
+    def move_steps(self, steps, rpm=15, accel=None, jerk=None):
+        """Moves each stepper by its entry in steps (of its current mode)
+        
+        Returns the number of ticks (steps of the longest axis) taken.
+        """
+        if len(steps) != len(self.steppers):
+            raise ValueError("Need one step count per stepper")
+        
+        with self._locked():
+            return self._move_steps(steps, rpm, accel, jerk)
+    
+    def rotate_async(self, degrees, rpm=15, accel=None, jerk=None):
+        """Queues rotate() on the motion thread; returns a Future"""
+        return self.motion.submit(self.rotate, degrees, rpm, accel, jerk)
+    
+    def move_to_async(self, angles, rpm=15, accel=None, jerk=None):
+        """Queues move_to() on the motion thread; returns a Future"""
+        return self.motion.submit(self.move_to, angles, rpm, accel, jerk)
+    
+    def cleanup(self):
+        """Waits for queued moves; the steppers are cleaned up by their owner"""
+        self.motion.shutdown(wait=True)
+    
+    def _locked(self):
+        """Returns a context manager holding every stepper's move_lock
+        
+        The locks are always taken in the same (id) order, so two 
+        controllers sharing a stepper cannot deadlock.
+        """
+        stack = contextlib.ExitStack()
+        
+        for stepper in sorted(set(self.steppers), key=id):
+            stack.enter_context(stepper.move_lock)
+        
+        return stack
+    
+    def _move_steps(self, steps, rpm, accel, jerk):
+        """Stepping loop; called with every move_lock held"""
+        counts = [abs(int(count)) for count in steps]
+        ticks  = max(counts)
+        
+        # The longest axis sets the timing
+        lead = counts.index(ticks)
+        steps_per_rev = self.steppers[lead].mode_steps_per_rev()
+        
+        if accel is None:
+            intervals = array('d', [60.0 / (steps_per_rev * rpm)]) * ticks
+        else:
+            intervals = plan_move(ticks, rpm, accel, jerk, steps_per_rev)
+        
+        axes = []
+        
+        for stepper, count, requested in zip(self.steppers, counts, steps):
+            if count == 0:
+                continue
+            
+            direction = -1 if requested < 0 else 1
+            sequencer = stepper.sequencer
+            
+            with stepper.state_lock:
+                stepper.direction = direction
+            
+            stepper.moving = True
+            
+            # Bresenham error term, started half way so steps are centred
+            axes.append([stepper, count, ticks // 2, direction, sequencer,
+                         sequencer.table, sequencer.successors(direction)])
+        
+        errors = array('d', [0.0]) * ticks
+        self.step_errors = errors
+        
+        start = time.monotonic()
+        deadline = start
+        
+        try:
+            for tick in range(ticks):
+                now = wait_until(deadline)
+                
+                for axis in axes:
+                    stepper, count, error, direction, sequencer, table, next_phase = axis
+                    
+                    error += count
+                    
+                    if error >= ticks:
+                        error -= ticks
+                        phase = next_phase[sequencer.phase]
+                        stepper.coils.write(table[phase])
+                        
+                        with stepper.state_lock:
+                            sequencer.phase = phase
+                            stepper.position += direction
+                    
+                    axis[2] = error
+                
+                errors[tick] = now - deadline
+                deadline += intervals[tick]
+            
+            # Hold the last step for its full interval
+            self.move_time = wait_until(deadline) - start
+        finally:
+            for axis in axes:
+                stepper = axis[0]
+                stepper.coils.write(OFF_PATTERN)
+                stepper.moving = False
+        
+        return ticks
+
 
 def main():
     stepper = Stepper()
@@ -35,9 +35,69 @@ Controls dc motor specific to the operation of dealing cards:
 - checks light sensor to ensure cards are placed correctly on the device
 - spins dc motor enough to deal a single card from the top of the deck
 
+The motor is driven by PWM, so dc_motor (and reverse_pin) should be PWM 
+capable pins (e.g. P2_1 or P1_36).  If PWM cannot be started on a pin, it
+is driven as a plain GPIO output instead: on for any duty above 0, off 
+otherwise (no ramp or duty control).  In closed loop mode (the default) a
+deal ramps the duty up over ramp_time and runs until the light sensor 
+sees the card leave (wait_for_clear(), from raw reads rather than the 
+filtered sampler state), then cuts power straight away, so a deal takes 
+as long as the card really needs.  If the card has not left after timeout
+seconds, power is cut and the deal reports a failure.  With
+closed_loop=False the motor runs for DEAL_TIME like before.
+
+    deal(duty=None, ramp_time=None, timeout=None)
+      - Returns True once a card has been dealt
+      - Raises DeckEmptyError if no card is in position within 
+        CARD_WAIT_TIME
+      - If the card does not leave before the timeout (a jam), pulses the 
+        motor in reverse for REVERSE_PULSE_TIME to free it and tries 
+        again, up to JAM_RETRIES times, then raises CardJamError.  Both
+        errors are DealErrors, so the caller can pause the game, have the
+        deck fixed and deal again.
+      - The reverse pulse needs reverse_pin (the second input of an H 
+        bridge); without it the motor is just left off for the pulse time
+      - Arguments left as None come from the learner (or DEAL_DUTY, 
+        DEAL_RAMP_TIME, DEAL_TIMEOUT with learning off)
+    
+    last_deal_time
+      - Time from motor start to card exit of the last deal (None if it 
+        timed out)
+
+DealTimingLearner adapts the deal to the deck.  Each closed loop deal 
+records the time from motor start to card exit (or a failure).  It keeps
+an EWMA and the recent times in a ring buffer (for percentiles), and 
+after each deal picks the parameters for the next card:
+    - every LEARN_STREAK clean deals, duty goes up by DUTY_STEP (up to 
+      MAX_DUTY) only if the EWMA exit time has dropped by LEARN_GAIN since
+      the last check; if it has grown by LEARN_GAIN instead, the last step
+      is undone.  Once more duty stops making deals faster, it is held 
+      there.  A failure drops duty by DUTY_BACKOFF.
+    - ramp_time follows RAMP_FRACTION of the EWMA exit time (slow decks 
+      get a gentler start); it lengthens after a failure (a gentler start
+      slips less) and shortens back towards that target as deals succeed
+    - timeout is TIMEOUT_MARGIN times the 95th percentile exit time, 
+      once LEARN_MIN_SAMPLES deals have been seen; it grows after a 
+      failure.  It may go past DEAL_TIMEOUT, up to MAX_TIMEOUT, for decks
+      that need longer.
+The learned parameters are saved as JSON to learn_path (default 
+DEAL_TIMING_PATH) every SAVE_EVERY deals and on cleanup(), and loaded 
+again on start; learn_path=None turns learning off.
+
+deal_async() deals on the motor's own motion thread and returns a 
+concurrent.futures.Future that completes as soon as the card is out.  The
+thread then waits SPIN_DOWN_TIME for the rollers to stop before it starts
+the next queued deal, so the caller can start the next stepper move while 
+the motor spins down.
+
 """
 
+import os
+import json
 import time
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import Adafruit_BBIO.GPIO as GPIO
 import Adafruit_BBIO.PWM as PWM
 
@@ -47,7 +107,39 @@ import light_sensor as light
 # Constants
 # ------------------------------------------------------------------------
 
-
+SPIN_DOWN_TIME = 0.2            # Time for the rollers to stop after power off (s)
+
+PWM_FREQUENCY  = 2000           # Hz
+DEAL_DUTY      = 0.8            # Duty (0.0 - 1.0) once ramped up
+DEAL_RAMP_TIME = 0.05           # Time to ramp from 0 to the deal duty (s)
+DEAL_TIMEOUT   = 1.0            # Give up if the card has not left (s)
+DEAL_TIME      = 1.0            # Run time when not closed loop (s)
+RAMP_STEPS     = 5              # Duty steps in the ramp
+
+# Deal timing learner
+DEAL_TIMING_PATH  = os.path.expanduser("~/.dealerbot_deal_timing.json")
+LEARN_ALPHA       = 0.2         # EWMA weight of the newest deal
+LEARN_WINDOW      = 64          # Recent exit times kept for percentiles
+LEARN_MIN_SAMPLES = 8           # Deals before the timeout is learned
+LEARN_STREAK      = 5           # Clean deals between duty changes
+LEARN_GAIN        = 0.01        # EWMA change counted as faster / slower
+MIN_DUTY          = 0.4
+MAX_DUTY          = 1.0
+DUTY_STEP         = 0.02
+DUTY_BACKOFF      = 0.1
+MIN_RAMP_TIME     = 0.01
+MAX_RAMP_TIME     = 0.2
+RAMP_FRACTION     = 0.1         # Ramp time target = fraction * EWMA exit time
+MIN_TIMEOUT       = 0.2
+MAX_TIMEOUT       = 3.0
+TIMEOUT_MARGIN    = 2.0         # Timeout = margin * 95th percentile
+SAVE_EVERY        = 10          # Deals between saves
+
+# Jam / empty deck recovery
+CARD_WAIT_TIME     = 0.5        # Time for a card to settle in position (s)
+JAM_RETRIES        = 2          # Reverse pulse + retry attempts after a jam
+REVERSE_DUTY       = 0.6
+REVERSE_PULSE_TIME = 0.1        # (s)
 
 # ------------------------------------------------------------------------
 # Global variables
@@ -59,46 +151,427 @@ import light_sensor as light
 # Functions / Classes
 # ------------------------------------------------------------------------
 
+class DealError(Exception):
+    """Raised when a card could not be dealt"""
+    pass
+
+
+class DeckEmptyError(DealError):
+    """Raised when there is no card in position to deal"""
+    pass
+
+
+class CardJamError(DealError):
+    """Raised when a card does not leave after every retry"""
+    def __init__(self, attempts):
+        DealError.__init__(self, "Card jammed after {0} attempts".format(attempts))
+        self.attempts = attempts
+
+
+class DealTimingLearner():
+    """ Learns the deal duty / ramp / timeout from observed exit times """
+    path      = None
+    duty      = None
+    ramp_time = None
+    timeout   = None
+    ewma      = None
+    step_ewma = None
+    deals     = 0
+    failures  = 0
+    streak    = 0
+    times     = None
+    index     = 0
+    count     = 0
+    unsaved   = 0
+    
+    def __init__(self, path = DEAL_TIMING_PATH):
+        """ Start from the defaults; Load saved parameters if there are any """
+        self.path      = path
+        self.duty      = DEAL_DUTY
+        self.ramp_time = DEAL_RAMP_TIME
+        self.timeout   = DEAL_TIMEOUT
+        self.ewma      = None
+        self.step_ewma = None
+        self.deals     = 0
+        self.failures  = 0
+        self.streak    = 0
+        self.times     = array('d', [0.0]) * LEARN_WINDOW
+        self.index     = 0
+        self.count     = 0
+        self.unsaved   = 0
+        
+        if path is not None:
+            self.load()
+    
+    # End def
+
+    def parameters(self):
+        """Returns (duty, ramp_time, timeout) for the next deal"""
+        return (self.duty, self.ramp_time, self.timeout)
+    
+    # End def
+
+    def percentile(self, fraction):
+        """Returns the given percentile (0.0 - 1.0) of the recent exit times"""
+        if self.count == 0:
+            return None
+        
+        ordered = sorted(self.times[:self.count])
+        return ordered[min(self.count - 1, int(fraction * self.count))]
+    
+    # End def
+
+    def record(self, exit_time):
+        """Record one deal (exit_time None if the card did not leave)"""
+        self.deals += 1
+        
+        if exit_time is None:
+            # Back off: slower and gentler, and allow more time
+            self.failures += 1
+            self.streak    = 0
+            self.duty      = max(MIN_DUTY, self.duty - DUTY_BACKOFF)
+            self.ramp_time = min(MAX_RAMP_TIME, self.ramp_time * 1.5)
+            self.timeout   = min(MAX_TIMEOUT, self.timeout * 1.5)
+            self.step_ewma = None
+        else:
+            if self.ewma is None:
+                self.ewma = exit_time
+            else:
+                self.ewma += LEARN_ALPHA * (exit_time - self.ewma)
+            
+            self.times[self.index] = exit_time
+            self.index = (self.index + 1) % LEARN_WINDOW
+            self.count = min(self.count + 1, LEARN_WINDOW)
+            
+            self.streak   += 1
+            target         = min(MAX_RAMP_TIME, 
+                                 max(MIN_RAMP_TIME, RAMP_FRACTION * self.ewma))
+            self.ramp_time = max(target, self.ramp_time * 0.9)
+            
+            if self.streak >= LEARN_STREAK:
+                self._step_duty()
+                self.streak = 0
+            
+            if self.count >= LEARN_MIN_SAMPLES:
+                self.timeout = min(MAX_TIMEOUT, 
+                                   max(MIN_TIMEOUT, TIMEOUT_MARGIN * self.percentile(0.95)))
+        
+        self.unsaved += 1
+        
+        if (self.path is not None) and (self.unsaved >= SAVE_EVERY):
+            self.save()
+    
+    # End def
+
+    def _step_duty(self):
+        """Raise the duty while it makes deals faster; Undo it if slower"""
+        if self.step_ewma is None:
+            # No reference yet (start, or a failure): try one step up
+            self.duty = min(MAX_DUTY, self.duty + DUTY_STEP)
+        elif self.ewma < self.step_ewma * (1.0 - LEARN_GAIN):
+            self.duty = min(MAX_DUTY, self.duty + DUTY_STEP)
+        elif self.ewma > self.step_ewma * (1.0 + LEARN_GAIN):
+            self.duty = max(MIN_DUTY, self.duty - DUTY_STEP)
+        
+        # Otherwise more duty no longer helps; hold it where it is
+        self.step_ewma = self.ewma
+    
+    # End def
+
+    def stats(self):
+        """Returns the learned parameters and exit time statistics"""
+        return {"duty"      : self.duty,
+                "ramp_time" : self.ramp_time,
+                "timeout"   : self.timeout,
+                "ewma"      : self.ewma,
+                "p50"       : self.percentile(0.5),
+                "p95"       : self.percentile(0.95),
+                "deals"     : self.deals,
+                "failures"  : self.failures}
+    
+    # End def
+
+    def save(self):
+        """Save the learned parameters (written to a temporary file first)"""
+        state = {"duty"      : self.duty,
+                 "ramp_time" : self.ramp_time,
+                 "timeout"   : self.timeout,
+                 "ewma"      : self.ewma,
+                 "step_ewma" : self.step_ewma,
+                 "times"     : list(self.times[:self.count])}
+        
+        try:
+            with open(self.path + ".tmp", "w") as file:
+                json.dump(state, file)
+            os.replace(self.path + ".tmp", self.path)
+            self.unsaved = 0
+        except (OSError, IOError) as error:
+            print("Could not save deal timing ({0})".format(error))
+    
+    # End def
+
+    def load(self):
+        """Load saved parameters; Keep the defaults if there are none"""
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+            
+            duty      = float(state["duty"])
+            ramp_time = float(state["ramp_time"])
+            timeout   = float(state["timeout"])
+            ewma      = state.get("ewma")
+            step_ewma = state.get("step_ewma")
+            times     = [float(t) for t in state.get("times", [])][-LEARN_WINDOW:]
+        except FileNotFoundError:
+            return
+        except (OSError, IOError, ValueError, KeyError, TypeError) as error:
+            print("Could not load deal timing ({0}); using defaults".format(error))
+            return
+        
+        self.duty      = min(MAX_DUTY, max(MIN_DUTY, duty))
+        self.ramp_time = min(MAX_RAMP_TIME, max(MIN_RAMP_TIME, ramp_time))
+        self.timeout   = min(MAX_TIMEOUT, max(MIN_TIMEOUT, timeout))
+        self.ewma      = None if ewma is None else float(ewma)
+        self.step_ewma = None if step_ewma is None else float(step_ewma)
+        
+        for i, exit_time in enumerate(times):
+            self.times[i] = exit_time
+        
+        self.count = len(times)
+        self.index = self.count % LEARN_WINDOW
+    
+    # End def
+
+# End class
+
+
 class DCMotor():
     """ Servo """
-    dc_motor      = None
+    dc_motor       = None
+    motion         = None
+    closed_loop    = None
+    last_deal_time = None
+    learner        = None
+    reverse_pin    = None
+    pwm_pins       = None
+    jams           = 0
     
-    def __init__(self, dc_motor = "", light_bus = 1, light_address = 0x29):
+    def __init__(self, dc_motor = "P2_1", light_bus = 1, light_address = 0x29,
+                 light_backend = light.BACKEND_I2C, light_interrupt_pin = None,
+                 events = None, closed_loop = True, learn_path = DEAL_TIMING_PATH,
+                 reverse_pin = None):
         """ Initialize variables and set up display """
         self.dc_motor      = dc_motor
+        self.closed_loop   = closed_loop
+        self.reverse_pin   = reverse_pin
+        self.pwm_pins      = set()
+        self.jams          = 0
+        
+        if closed_loop and (learn_path is not None):
+            self.learner = DealTimingLearner(learn_path)
+        
         self._setup()
-        self.lightsensor = light.LightSensor(light_bus = light_bus, light_address = light_address)
+        self.lightsensor = light.LightSensor(light_bus = light_bus, light_address = light_address,
+                                             backend = light_backend,
+                                             interrupt_pin = light_interrupt_pin,
+                                             events = events)
+        
+        # Motion thread for deal_async()
+        self.motion = ThreadPoolExecutor(max_workers=1)
     
     # End def
     
     
     def _setup(self):
         """Setup the hardware components."""
-        pass
+        # Start PWM with the motor off
+        self._start_pin(self.dc_motor)
+        
+        if self.reverse_pin is not None:
+            self._start_pin(self.reverse_pin)
+
+    # End def
+
+
+    def _start_pin(self, pin):
+        """Start PWM on pin at 0 duty; Fall back to a GPIO output if it fails"""
+        try:
+            PWM.start(pin, 0.0, PWM_FREQUENCY)
+            self.pwm_pins.add(pin)
+        except (ValueError, RuntimeError) as error:
+            print("PWM not available on {0} ({1}); driving it on / off".format(pin, error))
+            GPIO.setup(pin, GPIO.OUT)
+            GPIO.output(pin, GPIO.LOW)
 
     # End def
 
 
-    def deal(self):
-        """Spin DC Motor to deal a card"""
-        # Set servo
+    def _set_pin(self, pin, duty):
+        """Set the duty (0.0 - 1.0) of pin; Without PWM, on for any duty > 0"""
+        if pin in self.pwm_pins:
+            PWM.set_duty_cycle(pin, duty * 100.0)
+        elif duty > 0.0:
+            GPIO.output(pin, GPIO.HIGH)
+        else:
+            GPIO.output(pin, GPIO.LOW)
+
+    # End def
+
+
+    def _stop_pin(self, pin):
+        """Stop PWM on pin, or switch the GPIO output off"""
+        if pin in self.pwm_pins:
+            PWM.stop(pin)
+        else:
+            GPIO.output(pin, GPIO.LOW)
+
+    # End def
+
+
+    def deal(self, duty = None, ramp_time = None, timeout = None):
+        """Spin DC Motor to deal a card; Returns True once a card is dealt
+        
+        Raises DeckEmptyError if there is no card, or CardJamError if the 
+        card is still there after JAM_RETRIES reverse pulses and retries.
+        
+        Only the first attempt is recorded by the learner, so a jam backs 
+        it off once; the retries use the backed off parameters.
+        """
+        # Set servo; give a card that is still dropping time to settle
         lighttest = self.lightsensor.in_position()
         print(lighttest)
-        if lighttest == 1:
-            self._deal_a_card()
+        if lighttest != 1:
+            if not self.lightsensor.wait_for_card(CARD_WAIT_TIME):
+                raise DeckEmptyError("No card in position")
+        
+        for attempt in range(JAM_RETRIES + 1):
+            if attempt > 0:
+                print("Card jammed; retry {0} of {1}".format(attempt, JAM_RETRIES))
+                self._reverse_pulse()
+            
+            if self.learner is not None:
+                learned = self.learner.parameters()
+            else:
+                learned = (DEAL_DUTY, DEAL_RAMP_TIME, DEAL_TIMEOUT)
+            
+            dealt = self._deal_a_card(learned[0] if duty is None else duty,
+                                      learned[1] if ramp_time is None else ramp_time,
+                                      learned[2] if timeout is None else timeout)
+            
+            if (self.learner is not None) and (attempt == 0):
+                self.learner.record(self.last_deal_time)
+            
+            if dealt:
+                return True
+        
+        self.jams += 1
+        raise CardJamError(JAM_RETRIES + 1)
+    # End def
+
+    def wait_for_card(self, timeout = None):
+        """Wait for a card to be placed; Returns False on timeout"""
+        return self.lightsensor.wait_for_card(timeout)
+    
+    # End def
+
+    def deal_async(self):
+        """Queue a deal on the motion thread
+        
+        Returns a Future that completes when the card is out (before the
+        motor has spun down).  A DealError from deal() is raised by the 
+        Future's result().
+        """
+        card_out = Future()
+        self.motion.submit(self._deal_job, card_out)
+        return card_out
+    
+    # End def
+
+    def _deal_job(self, card_out):
+        """Deal a card; Report it; Let the motor spin down"""
+        if not card_out.set_running_or_notify_cancel():
+            return
+        
+        try:
+            card_out.set_result(self.deal())
+        except Exception as error:
+            card_out.set_exception(error)
+            return
+        
+        time.sleep(SPIN_DOWN_TIME)
+    
+    # End def
+
+    def _set_duty(self, duty):
+        """Set the motor duty (0.0 - 1.0)"""
+        self._set_pin(self.dc_motor, duty)
+    
+    # End def
+
+    def _reverse_pulse(self):
+        """Briefly run the motor backwards to pull a jammed card back"""
+        self._set_duty(0.0)
+        
+        if self.reverse_pin is None:
+            time.sleep(REVERSE_PULSE_TIME)
+            return
+        
+        try:
+            self._set_pin(self.reverse_pin, REVERSE_DUTY)
+            time.sleep(REVERSE_PULSE_TIME)
+        finally:
+            self._set_pin(self.reverse_pin, 0.0)
+        
+        # Let the rollers stop before driving forwards again
+        time.sleep(SPIN_DOWN_TIME)
+    
     # End def
 
-    def _deal_a_card(self):
-        """Action of spinning motor"""
+    def _deal_a_card(self, duty = DEAL_DUTY, ramp_time = DEAL_RAMP_TIME, timeout = DEAL_TIMEOUT):
+        """Action of spinning motor; Returns True if the card left"""
         print("DC Motor ON")
-        time.sleep(1)
-        print("DC Motor OFF")
+        start = time.monotonic()
+        
+        try:
+            if not self.closed_loop:
+                self._set_duty(duty)
+                time.sleep(DEAL_TIME)
+                self.last_deal_time = DEAL_TIME
+                return True
+            
+            # Ramp up in steps, watching for the card the whole time
+            for step in range(1, RAMP_STEPS + 1):
+                self._set_duty(duty * step / RAMP_STEPS)
+                
+                if self.lightsensor.wait_for_clear(ramp_time / RAMP_STEPS):
+                    break
+            else:
+                remaining = start + timeout - time.monotonic()
+                
+                if not self.lightsensor.wait_for_clear(max(0.0, remaining)):
+                    print("Card did not leave within {0} s".format(timeout))
+                    self.last_deal_time = None
+                    return False
+            
+            self.last_deal_time = time.monotonic() - start
+            return True
+        finally:
+            self._set_duty(0.0)
+            print("DC Motor OFF")
     # End def
 
 
     def cleanup(self):
         """Cleanup the hardware components."""
-        pass
+        self.motion.shutdown(wait=True)
+        self._stop_pin(self.dc_motor)
+        
+        if self.reverse_pin is not None:
+            self._stop_pin(self.reverse_pin)
+        
+        if self.learner is not None:
+            self.learner.save()
+        self.lightsensor.cleanup()
     # End def
 
 # End class
@@ -41,15 +41,16 @@ Operation:
 - If Poker is chosen, the user can select the number of players again via the potentiometer and the button
     - When the user is ready for the cards in the flop, turn, or river to be dealt, they can press the push button to begin dealing
     - The device resets to the beginning after the river card is dealt
+
+- If the deck runs out or a card jams, the display shows "FILL" or "Stuc" and the game pauses; press the button once the deck is refilled or the jam is cleared to deal the same card again
     
 The ht16k33 class is provided by Erik Welsh for ENGI 301
 The bbpystepper class is adapted from Pete Bachant
 
 """
-import time
-
 import Adafruit_BBIO.GPIO as GPIO
 
+import gpio_events
 import ht16k33 as HT16K33
 import dc_motor as DC_MOTOR
 import bbpystepper as STEPPER_MOTOR
@@ -62,7 +63,8 @@ import Adafruit_BBIO.ADC as ADC
 # Constants
 # ------------------------------------------------------------------------
 
-# None
+BUTTON_DEBOUNCE    = 0.02       # Ignore button edges closer than this (s)
+POT_UPDATE_TIME    = 0.1        # Potentiometer re-read period while choosing (s)
 
 # ------------------------------------------------------------------------
 # Global variables
@@ -85,15 +87,22 @@ class DealerBot():
     button              = None
     dcmotor             = None
     steppermotor        = None
+    events              = None
+    button_watch        = None
+    deal_errors         = 0
     
-    def __init__(self, i2c_bus=1, i2c_address=0x70, dc_motor_pin = "P2_17",
-        stepper_motor_pin = ["P2_4", "P2_6", "P2_8", "P2_10"], button="P2_2", analog_in="P1_19"):
+    def __init__(self, i2c_bus=1, i2c_address=0x70, dc_motor_pin = "P2_1",
+        stepper_motor_pin = ("P2_4", "P2_6", "P2_8", "P2_10"), button="P2_2", analog_in="P1_19",
+        hall_interrupt_pin=None, light_interrupt_pin=None):
         """ Initialize variables and set up display """
         self.button       = button
-        self.display      = HT16K33.HT16K33(i2c_bus, i2c_address)
+        self.events       = gpio_events.EdgeEvents()
+        self.display      = HT16K33.HT16K33(i2c_bus, i2c_address, async_mode=True)
         self.analog_in    = analog_in
-        self.dcmotor      = DC_MOTOR.DCMotor(dc_motor = dc_motor_pin, light_bus = 1, light_address = 0x29)
-        self.steppermotor = STEPPER_MOTOR.Stepper(pins = stepper_motor_pin, hall_effect_bus = 1, hall_effect_address = 0x60)
+        self.dcmotor      = DC_MOTOR.DCMotor(dc_motor = dc_motor_pin, light_bus = i2c_bus, light_address = 0x29,
+                                             light_interrupt_pin = light_interrupt_pin, events = self.events)
+        self.steppermotor = STEPPER_MOTOR.Stepper(pins = stepper_motor_pin, hall_effect_bus = i2c_bus, hall_effect_address = 0x60,
+                                                  hall_interrupt_pin = hall_interrupt_pin, events = self.events)
 
         self.games        = [(0, 2047, self.start_poker, "po"),
                              (2048, 4095, self.war, "UUar")]
@@ -111,8 +120,9 @@ class DealerBot():
 
         print("Initialize Display")
         
-        # Check Light Sensor
+        # Check Light Sensor; card present decisions use the filtered state
         print("Check Light Sensor")
+        self.dcmotor.lightsensor.start_sampling()
         
         # Calibrate Hall Effect
         print("Calibrate Hall Effect")
@@ -120,21 +130,68 @@ class DealerBot():
         # Initialize Analog Input
         print("Initialize analog input")
         #ADC.setup()
+        
+        # Button is active low; presses are delivered by the event thread
+        print("Initialize button")
+        self.button_watch = self.events.watch(self.button, gpio_events.EDGE_FALLING,
+                                              debounce=BUTTON_DEBOUNCE, active_low=True)
 
     # End def
     
     
+    def wait_for_button(self, timeout=None, count=None):
+        """Wait for the next button press; Returns False on timeout
+        
+        If count is given (a button_watch.count read earlier), a press made
+        since then ends the wait straight away.
+        """
+        return self.button_watch.wait(timeout, count)
+
+    # End def
+    
+    def turn(self, degrees):
+        """Rotate the stepper motor on its motion thread and wait for it"""
+        self.steppermotor.rotate_async(degrees = degrees).result()
+
+    # End def
+
+    def deal_card(self):
+        """Deal a card and wait until it is out
+        
+        The DC motor spins down on its own thread, so the next stepper move
+        can start straight away.  If the deck is empty or a card jams, the 
+        game pauses: the display shows the problem until the button is 
+        pressed (once the deck is refilled / the jam cleared), then the 
+        same card is dealt again.
+        """
+        while True:
+            try:
+                return self.dcmotor.deal_async().result()
+            except DC_MOTOR.DeckEmptyError:
+                print("Deck empty; refill and press the button")
+                self.deal_errors += 1
+                self.display.text("FILL")
+            except DC_MOTOR.CardJamError as error:
+                print("{0}; clear the jam and press the button".format(error))
+                self.deal_errors += 1
+                self.display.text("Stuc")
+            
+            self.wait_for_button()
+            self.display.blank()
+
+    # End def
+
     def deal_around(self, players = 1):
         """Deal a card to each player in the game:
                - rotate stepper motor depending on number of players
                - Call dcmotor.deal
         """
 
-        for i in players:
-            self.steppermotor.rotate(degrees = 180/(players + 1))
+        for i in range(players):
+            self.turn(180/(players + 1))
             
-                # Call deal a card          
-            self.dcmotor.deal()
+            # Call deal a card          
+            self.deal_card()
         self.steppermotor.go_to_initial_position()
 
     # End def    
@@ -151,7 +208,7 @@ class DealerBot():
         self.steppermotor.go_to_initial_position()
         
         # Call deal a card
-        self.dcmotor.deal()
+        self.deal_card()
 
     # End def
 
@@ -163,8 +220,8 @@ class DealerBot():
         """
         self.burn_a_card()
         for i in range(3):
-            self.steppermotor.rotate(degrees = 30)
-            self.dc_motor.deal()
+            self.turn(30)
+            self.deal_card()
         self.steppermotor.go_to_initial_position()
     # End def
     
@@ -175,8 +232,8 @@ class DealerBot():
             - returns to original position
         """
         self.burn_a_card()
-        self.steppermotor.rotate(degrees = 120)
-        self.dc_motor.deal()
+        self.turn(120)
+        self.deal_card()
         self.steppermotor.go_to_initial_position()
     # End def
     
@@ -187,8 +244,8 @@ class DealerBot():
             - returns to original position
         """
         self.burn_a_card()
-        self.steppermotor.rotate(degrees = 150)
-        self.dc_motor.deal()
+        self.turn(150)
+        self.deal_card()
         self.steppermotor.go_to_initial_position()
     # End def
     
@@ -196,13 +253,13 @@ class DealerBot():
         """ Deals every card in the deck into two even piles """
         
         self.steppermotor.go_to_initial_position()
-        self.steppermotor.rotate(degrees = 60)
+        self.turn(60)
         
         for i in range(26):
-            self.dcmotor.deal()
-            self.steppermotor.rotate(degrees = 60)
-            self.dcmotor.deal()
-            self.steppermotor.rotate(degrees = -60)
+            self.deal_card()
+            self.turn(60)
+            self.deal_card()
+            self.turn(-60)
         
         self.steppermotor.go_to_initial_position()
     
@@ -213,26 +270,17 @@ class DealerBot():
         
         self.deal_around(players) 
         
-        self.display.update("flop")
-        while(self.button == 1):
-            time.sleep(0.1)
-        while(self.button == 0):
-            time.sleep(0.1)
-            self.poker_flop()
+        self.display.text("flop")
+        self.wait_for_button()
+        self.poker_flop()
             
-        self.display.update("turn")
-        while(self.button == 1):
-            time.sleep(0.1)
-        while(self.button == 0):
-            time.sleep(0.1)
-            self.poker_turn()
+        self.display.text("turn")
+        self.wait_for_button()
+        self.poker_turn()
             
-        self.display.update("ri")
-        while(self.button == 1):
-            time.sleep(0.1)
-        while(self.button == 0):
-            time.sleep(0.1)
-            self.poker_river()
+        self.display.text("ri")
+        self.wait_for_button()
+        self.poker_river()
     # End def
     
     def start_poker(self):
@@ -242,29 +290,29 @@ class DealerBot():
     # End def
     
     
-    def check_pot(self):
+    def check_pot(self, values):
         """Updates the value of the potentiometer to the HEX display based on user assignments from input"""
         ret_val = None
-        pot_val = self.ADC.read_raw(self.analog_in)
+        pot_val = ADC.read_raw(self.analog_in)
         
-        for game in self.games:
-            if (pot_value >= game[0]) and (pot_value <= game[1]):
-                self.display.update(game[3])
-                ret_value = game[2]
+        for value in values:
+            if (pot_val >= value[0]) and (pot_val <= value[1]):
+                self.display.text(value[3])
+                ret_val = value[2]
         return ret_val
         
     # End def   
     
     def choose_val(self, values):
         """Allows a value displayed by the HEX display to be chosen via a button push"""
-        ret_val = None
+        presses = self.button_watch.count
+        ret_val = self.check_pot(values)
         
-        while(self.button == 1):
+        # The potentiometer has no edge to wait for, so it is re-read every
+        # POT_UPDATE_TIME; a button press ends the wait as soon as it happens,
+        # including one made while the potentiometer was being read
+        while not self.wait_for_button(POT_UPDATE_TIME, presses):
             ret_val = self.check_pot(values)
-            time.sleep(0.1)
-            
-        while(self.button == 0):
-            time.sleep(0.1)
 
         return ret_val
         
@@ -274,10 +322,8 @@ class DealerBot():
     def run(self):
         """Execute the main program."""
         
-        self.display.set_game()
-        
         while(True):
-            self.display.update("ga")
+            self.display.text("ga")
             
             game = self.choose_val(self.games)
             game()
@@ -288,6 +334,13 @@ class DealerBot():
         """Cleanup the hardware components."""
         # self.steppermotor.go_to_initial_position()
         print("Clean up hardware components")
+        
+        self.display.blank()
+        self.display.close()
+        
+        self.dcmotor.cleanup()
+        self.steppermotor.cleanup()
+        self.events.close()
 
         
     # End def
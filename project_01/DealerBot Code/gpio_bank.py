@@ -0,0 +1,303 @@
+"""
+--------------------------------------------------------------------------
+GPIO Bank
+--------------------------------------------------------------------------
+License:
+Copyright 2022 Abinand Parthasarathy
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+may be used to endorse or promote products derived from this software without
+specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+--------------------------------------------------------------------------
+Software API:
+
+  open_pins(pins, backend=BACKEND_MMAP)
+    - Returns an object that writes a pattern to a group of output pins
+    - BACKEND_MMAP writes the AM335x GPIO set / clear registers through
+      /dev/mem; each pattern costs one clear and one set write per bank,
+      with every bank cleared before any is set
+    - BACKEND_LIBRARY calls Adafruit_BBIO.GPIO.output() once per pin
+    - BACKEND_PWM drives each pin with Adafruit_BBIO.PWM, so states may be
+      duty fractions between 0.0 and 1.0 (pins must be PWM capable)
+    - If the registers cannot be mapped (no access to /dev/mem or a pin
+      that is not in PIN_GPIO), falls back to BACKEND_LIBRARY
+
+  Pin objects provide:
+    write(states)
+      - Drive pins[i] high if states[i] is true, else low
+
+    pwm
+      - True if write() accepts duty fractions
+
+    close()
+      - Release the register mapping
+
+  MMapGPIOPins(pins, path=DEV_MEM, bank_base=GPIO_BANK_BASE)
+    - path / bank_base can point at an ordinary file holding one 4 KB
+      page per bank (bank_base=[0x0000, 0x1000, 0x2000, 0x3000]) to test
+      without hardware.  The registers written are then visible in the
+      file.
+
+--------------------------------------------------------------------------
+Background Information:
+
+  * AM335x Technical Reference Manual, chapter 25 (GPIO):
+    * https://www.ti.com/lit/ug/spruh73q/spruh73q.pdf
+
+"""
+import os
+import mmap
+import struct
+
+import Adafruit_BBIO.GPIO as GPIO
+import Adafruit_BBIO.PWM as PWM
+
+
+# ------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------
+
+DEV_MEM                     = "/dev/mem"
+
+GPIO_BANK_BASE              = [0x44E07000, 0x4804C000, 0x481AC000, 0x481AE000]
+GPIO_BANK_SIZE              = 0x1000
+GPIO_PINS_PER_BANK          = 32
+
+GPIO_DATAOUT                = 0x13C
+GPIO_CLEARDATAOUT           = 0x190
+GPIO_SETDATAOUT             = 0x194
+
+# Header pin to kernel GPIO number (bank * 32 + bit)
+PIN_GPIO                    = { "P8_7"  : 66,  "P8_8"  : 67,  "P8_9"  : 69,
+                                "P8_10" : 68,  "P8_11" : 45,  "P8_12" : 44,
+                                "P8_13" : 23,  "P8_14" : 26,  "P8_15" : 47,
+                                "P8_16" : 46,  "P8_17" : 27,  "P8_18" : 65,
+                                "P8_19" : 22,
+                                "P2_1"  : 50,  "P2_2"  : 59,  "P2_3"  : 23,
+                                "P2_4"  : 58,  "P2_5"  : 30,  "P2_6"  : 57,
+                                "P2_7"  : 31,  "P2_8"  : 60,  "P2_9"  : 15,
+                                "P2_10" : 52,  "P2_11" : 14,  "P2_17" : 65,
+                                "P2_18" : 47,  "P2_19" : 27,  "P2_20" : 64,
+                                "P2_22" : 46,  "P2_24" : 44,  "P2_25" : 41,
+                                "P2_27" : 40,  "P2_28" : 116, "P2_29" : 7,
+                                "P2_30" : 113, "P2_31" : 19,  "P2_32" : 112,
+                                "P2_33" : 45,  "P2_34" : 111, "P2_35" : 86
+                              }
+
+PWM_FREQUENCY               = 20000             # Hz; above audible range
+
+BACKEND_MMAP                = "mmap"
+BACKEND_LIBRARY             = "library"
+BACKEND_PWM                 = "pwm"
+
+
+# ------------------------------------------------------------------------
+# Functions / Classes
+# ------------------------------------------------------------------------
+
+def pin_to_gpio(pin):
+    """ Returns (bank, bit) for a header pin such as "P2_04" """
+    header, number = pin.split("_")
+    name = "{0}_{1}".format(header, int(number))
+
+    if name not in PIN_GPIO:
+        raise ValueError("No GPIO register mapping for pin {0}".format(pin))
+
+    return divmod(PIN_GPIO[name], GPIO_PINS_PER_BANK)
+
+# End def
+
+
+class GPIOPins():
+    """ Write pin patterns with one Adafruit_BBIO.GPIO.output() per pin """
+    pins = None
+    pwm  = False
+
+    def __init__(self, pins):
+        """ Initialize class variables """
+        self.pins = list(pins)
+
+    # End def
+
+    def write(self, states):
+        """ Drive each pin high / low """
+        for pin, state in zip(self.pins, states):
+            if state:
+                GPIO.output(pin, GPIO.HIGH)
+            else:
+                GPIO.output(pin, GPIO.LOW)
+
+    # End def
+
+    def close(self):
+        """ Nothing to release """
+        pass
+
+    # End def
+
+# End class
+
+
+class PWMPins():
+    """ Write pin duty fractions with Adafruit_BBIO.PWM """
+    pins   = None
+    duties = None
+    pwm    = True
+
+    def __init__(self, pins, frequency=PWM_FREQUENCY):
+        """ Start PWM on each pin with the outputs off """
+        self.pins   = list(pins)
+        self.duties = [0.0] * len(self.pins)
+
+        for pin in self.pins:
+            PWM.start(pin, 0.0, frequency)
+
+    # End def
+
+    def write(self, states):
+        """ Set the duty of each pin (0.0 - 1.0); unchanged pins are skipped """
+        for i, state in enumerate(states):
+            duty = float(state)
+
+            if duty != self.duties[i]:
+                PWM.set_duty_cycle(self.pins[i], duty * 100.0)
+                self.duties[i] = duty
+
+    # End def
+
+    def close(self):
+        """ Stop PWM on each pin """
+        for pin in self.pins:
+            PWM.stop(pin)
+
+    # End def
+
+# End class
+
+
+class MMapGPIOPins():
+    """ Write pin patterns straight to the GPIO set / clear registers """
+    pins     = None
+    pwm      = False
+    fd       = None
+    maps     = None
+    masks    = None
+    patterns = None
+
+    def __init__(self, pins, path=DEV_MEM, bank_base=GPIO_BANK_BASE):
+        """ Resolve each pin to a bank / bit mask; Map each bank used once """
+        self.pins     = list(pins)
+        self.maps     = {}
+        self.masks    = []
+        self.patterns = {}
+
+        locations = [pin_to_gpio(pin) for pin in self.pins]
+
+        self.fd = os.open(path, os.O_RDWR | os.O_SYNC)
+
+        try:
+            for bank, bit in locations:
+                if bank not in self.maps:
+                    self.maps[bank] = mmap.mmap(self.fd, GPIO_BANK_SIZE,
+                                                offset=bank_base[bank])
+
+                self.masks.append((bank, 1 << bit))
+        except:
+            self.close()
+            raise
+
+    # End def
+
+    def _registers(self, states):
+        """ Returns [(map, clear mask, set mask)] for one pattern """
+        low  = {}
+        high = {}
+
+        for (bank, mask), state in zip(self.masks, states):
+            if state:
+                high[bank] = high.get(bank, 0) | mask
+            else:
+                low[bank] = low.get(bank, 0) | mask
+
+        return [(self.maps[bank], low.get(bank, 0), high.get(bank, 0))
+                for bank in sorted(self.maps)]
+
+    # End def
+
+    def write(self, states):
+        """ Write a pattern with one clear and one set write per bank
+
+        Every bank is cleared before any bank is set, so the pins only ever
+        pass through a subset of the new pattern (even when they span two
+        banks), and no coil outside it is energized.
+        """
+        key = tuple(bool(state) for state in states)
+
+        if key not in self.patterns:
+            self.patterns[key] = self._registers(key)
+
+        for registers, low, high in self.patterns[key]:
+            if low:
+                struct.pack_into("<I", registers, GPIO_CLEARDATAOUT, low)
+
+        for registers, low, high in self.patterns[key]:
+            if high:
+                struct.pack_into("<I", registers, GPIO_SETDATAOUT, high)
+
+    # End def
+
+    def close(self):
+        """ Release the register mapping """
+        for registers in self.maps.values():
+            registers.close()
+
+        self.maps = {}
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # End def
+
+# End class
+
+
+def open_pins(pins, backend=BACKEND_MMAP):
+    """ Return a pin writer for the given pins """
+    if backend == BACKEND_LIBRARY:
+        return GPIOPins(pins)
+
+    if backend == BACKEND_PWM:
+        return PWMPins(pins)
+
+    if backend != BACKEND_MMAP:
+        raise ValueError("Unknown GPIO backend {0}".format(backend))
+
+    try:
+        return MMapGPIOPins(pins)
+    except (OSError, IOError, ValueError) as error:
+        print("Could not map GPIO registers ({0}); using Adafruit_BBIO".format(error))
+        return GPIOPins(pins)
+
+# End def
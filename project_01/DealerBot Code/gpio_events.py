@@ -0,0 +1,391 @@
+"""
+--------------------------------------------------------------------------
+GPIO Events
+--------------------------------------------------------------------------
+License:
+Copyright 2022 Abinand Parthasarathy
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+may be used to endorse or promote products derived from this software without
+specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+--------------------------------------------------------------------------
+Software API:
+
+  EdgeEvents()
+    - One thread that sleeps in epoll() until a watched GPIO input changes,
+      then dispatches the edge.  Nothing runs while no pin changes (the 
+      thread is woken through a pipe only to stop).
+    - Pins are watched through /sys/class/gpio/gpioN/value (edge files).
+      If the pin cannot be exported, falls back to 
+      Adafruit_BBIO.GPIO.add_event_detect(), which is also edge driven.
+
+    watch(pin, edge=EDGE_BOTH, debounce=0.0, active_low=False)
+      - Returns a PinWatch for the pin; edges closer than debounce seconds
+        to the previous edge (counted or not) are ignored, as are edges 
+        that leave a rising / falling watch at the wrong level.  The pin 
+        is always armed for both edges, so the ignored edges still 
+        restart the debounce time
+
+    close()
+      - Stop the thread and release the pins
+
+  default_events()
+    - Returns an EdgeEvents shared by the sensors that are not given one
+
+  PinWatch objects provide:
+    value
+      - Pin level after the last edge (read when the watch is created)
+
+    active
+      - True if the pin is at its active level (low if active_low)
+
+    count / last_time
+      - Number of edges counted and time.monotonic() of the last edge seen
+
+    add_callback(callback)
+      - callback(watch) is called on the event thread for each edge; keep 
+        it short
+
+    wait(timeout=None, count=None)
+      - Wait for the next edge; returns False on timeout.  If count is 
+        given, waits until watch.count differs from it
+
+    next_edge()
+      - Returns a concurrent.futures.Future for the next edge (its result 
+        is the edge time); use asyncio.wrap_future() to await it
+
+--------------------------------------------------------------------------
+Background Information:
+
+  * Linux sysfs GPIO interface:
+    * https://www.kernel.org/doc/Documentation/gpio/sysfs.txt
+
+"""
+import os
+import time
+import select
+import threading
+from concurrent.futures import Future
+
+import Adafruit_BBIO.GPIO as GPIO
+
+import gpio_bank
+
+
+# ------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------
+
+SYSFS_GPIO                  = "/sys/class/gpio"
+
+EDGE_RISING                 = "rising"
+EDGE_FALLING                = "falling"
+EDGE_BOTH                   = "both"
+
+EDGE_LEVELS                 = { EDGE_RISING  : True,
+                                EDGE_FALLING : False }
+
+LIBRARY_EDGES               = { EDGE_RISING  : GPIO.RISING,
+                                EDGE_FALLING : GPIO.FALLING,
+                                EDGE_BOTH    : GPIO.BOTH }
+
+
+# ------------------------------------------------------------------------
+# Global variables
+# ------------------------------------------------------------------------
+
+_default_events             = None
+_default_lock               = threading.Lock()
+
+
+# ------------------------------------------------------------------------
+# Functions / Classes
+# ------------------------------------------------------------------------
+
+class PinWatch():
+    """ Edges seen on one input pin """
+    pin        = None
+    edge       = None
+    debounce   = None
+    active_low = None
+    value      = None
+    count      = None
+    last_time  = None
+    callbacks  = None
+    condition  = None
+    futures    = None
+
+    def __init__(self, pin, edge, debounce, active_low, value):
+        """ Initialize class variables """
+        self.pin        = pin
+        self.edge       = edge
+        self.debounce   = debounce
+        self.active_low = active_low
+        self.value      = value
+        self.count      = 0
+        self.last_time  = None
+        self.callbacks  = []
+        self.condition  = threading.Condition()
+        self.futures    = []
+
+    # End def
+
+    @property
+    def active(self):
+        """ True if the pin is at its active level """
+        return bool(self.value) != bool(self.active_low)
+
+    # End def
+
+    def add_callback(self, callback):
+        """ Call callback(watch) on the event thread for every edge """
+        self.callbacks.append(callback)
+
+    # End def
+
+    def wait(self, timeout=None, count=None):
+        """ Wait for the next edge; Returns False on timeout
+        
+        If count is given, returns as soon as self.count differs from it, 
+        so an edge seen after count was read is not missed.
+        """
+        with self.condition:
+            if count is None:
+                count = self.count
+            return self.condition.wait_for(lambda: self.count != count, timeout)
+
+    # End def
+
+    def next_edge(self):
+        """ Returns a Future that completes (with the edge time) on the next edge """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        with self.condition:
+            self.futures.append(future)
+
+        return future
+
+    # End def
+
+    def _edge(self, value, now):
+        """ Record an edge and notify waiters; Called on the event thread """
+        with self.condition:
+            bouncing       = ((self.last_time is not None) and 
+                              (now - self.last_time < self.debounce))
+            expected       = EDGE_LEVELS.get(self.edge)
+            
+            # Every edge restarts the debounce time, so the bounce of a 
+            # release is not taken for a new press
+            self.value     = value
+            self.last_time = now
+
+            # Still bouncing, or the pin settled at the wrong level for the
+            # edge watched (e.g. a release seen on a falling edge watch)
+            if bouncing or ((expected is not None) and (bool(value) != expected)):
+                return
+
+            self.count    += 1
+            futures        = self.futures
+            self.futures   = []
+            self.condition.notify_all()
+
+        for future in futures:
+            future.set_result(now)
+
+        for callback in self.callbacks:
+            callback(self)
+
+    # End def
+
+# End class
+
+
+class EdgeEvents():
+    """ Dispatch GPIO edges from one epoll() thread """
+    poll     = None
+    watches  = None
+    files    = None
+    wake_r   = None
+    wake_w   = None
+    thread   = None
+    running  = None
+    exported = None
+    library  = None
+
+    def __init__(self):
+        """ Create the epoll set and start the event thread """
+        self.poll     = select.epoll()
+        self.watches  = {}
+        self.files    = {}
+        self.exported = []
+        self.library  = []
+        self.running  = True
+
+        # A byte on this pipe wakes the thread so it can stop
+        self.wake_r, self.wake_w = os.pipe()
+        self.poll.register(self.wake_r, select.EPOLLIN)
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    # End def
+
+    def watch(self, pin, edge=EDGE_BOTH, debounce=0.0, active_low=False):
+        """ Returns a PinWatch for pin """
+        if edge not in LIBRARY_EDGES:
+            raise ValueError("Unknown edge {0}".format(edge))
+
+        try:
+            return self._watch_sysfs(pin, edge, debounce, active_low)
+        except (OSError, IOError, ValueError) as error:
+            print("Could not watch {0} through sysfs ({1}); using Adafruit_BBIO".format(pin, error))
+            return self._watch_library(pin, edge, debounce, active_low)
+
+    # End def
+
+    def _watch_sysfs(self, pin, edge, debounce, active_low):
+        """ Watch the value file of an exported sysfs GPIO """
+        bank, bit = gpio_bank.pin_to_gpio(pin)
+        number    = bank * gpio_bank.GPIO_PINS_PER_BANK + bit
+        path      = "{0}/gpio{1}".format(SYSFS_GPIO, number)
+
+        if not os.path.exists(path):
+            with open(SYSFS_GPIO + "/export", "w") as export:
+                export.write(str(number))
+            self.exported.append(number)
+
+        with open(path + "/direction", "w") as direction:
+            direction.write("in")
+
+        # Both edges are always armed: _edge() needs the edges it does not
+        # count to restart the debounce time
+        with open(path + "/edge", "w") as edge_file:
+            edge_file.write(EDGE_BOTH)
+
+        fd = os.open(path + "/value", os.O_RDONLY | os.O_NONBLOCK)
+
+        # Reading the value clears the pending edge
+        watch = PinWatch(pin, edge, debounce, active_low, self._read(fd))
+
+        self.files[fd]   = watch
+        self.watches[pin] = watch
+        self.poll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+
+        return watch
+
+    # End def
+
+    def _watch_library(self, pin, edge, debounce, active_low):
+        """ Watch a pin with Adafruit_BBIO's own edge detection thread """
+        GPIO.setup(pin, GPIO.IN)
+
+        watch = PinWatch(pin, edge, debounce, active_low, GPIO.input(pin))
+
+        def callback(channel):
+            watch._edge(GPIO.input(pin), time.monotonic())
+
+        GPIO.add_event_detect(pin, LIBRARY_EDGES[EDGE_BOTH], callback=callback)
+
+        self.library.append(pin)
+        self.watches[pin] = watch
+
+        return watch
+
+    # End def
+
+    def _read(self, fd):
+        """ Read the level of a sysfs value file """
+        os.lseek(fd, 0, os.SEEK_SET)
+        return int(os.read(fd, 2)[:1] or b"0")
+
+    # End def
+
+    def _loop(self):
+        """ Sleep in epoll() until a pin changes; Dispatch the edges """
+        while self.running:
+            events = self.poll.poll()
+            now    = time.monotonic()
+
+            for fd, mask in events:
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 1)
+                    continue
+
+                watch = self.files.get(fd)
+
+                if watch is not None:
+                    watch._edge(self._read(fd), now)
+
+    # End def
+
+    def close(self):
+        """ Stop the thread and release the pins """
+        if not self.running:
+            return
+
+        self.running = False
+        os.write(self.wake_w, b"x")
+        self.thread.join()
+
+        for fd in self.files:
+            self.poll.unregister(fd)
+            os.close(fd)
+
+        self.files = {}
+
+        for pin in self.library:
+            GPIO.remove_event_detect(pin)
+
+        self.library = []
+
+        for number in self.exported:
+            try:
+                with open(SYSFS_GPIO + "/unexport", "w") as unexport:
+                    unexport.write(str(number))
+            except (OSError, IOError):
+                pass
+
+        self.exported = []
+
+        self.poll.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    # End def
+
+# End class
+
+
+def default_events():
+    """ Returns the EdgeEvents shared by objects that are not given one """
+    global _default_events
+
+    with _default_lock:
+        if _default_events is None:
+            _default_events = EdgeEvents()
+
+        return _default_events
+
+# End def
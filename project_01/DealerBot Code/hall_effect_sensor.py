@@ -33,16 +33,69 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 Simple class used to determine if the hall effect sensor is activated or not
 
+Driver for the Allegro ALS31300 3D linear hall effect sensor (default 
+address 0x60).  The bus is opened once in _setup(); each sample reads the
+X / Y / Z field registers (0x28 and 0x29) in one 8 byte burst.  The magnet
+is over the sensor when the Z field is stronger than HALL_THRESHOLD.
+
+  HallEffectSensor(hall_effect_bus=1, hall_effect_address=0x60, 
+                   backend=BACKEND_I2C)
+    - BACKEND_I2C reads the sensor through the shared i2c_bus.I2CBus for 
+      /dev/i2c-<bus>, at PRIORITY_SENSOR; if it cannot be opened or set 
+      up, falls back to BACKEND_SIMULATED
+    - BACKEND_SIMULATED returns random readings so the rest of DealerBot 
+      can run without the hardware
+
+  read_field()
+    - Returns the (x, y, z) field as signed 12-bit counts
+
+  With interrupt_pin set, the sensor's INT output is watched with 
+  gpio_events (events, or the shared default_events()).  in_position() 
+  then returns the pin level kept by the event thread, with no bus read, 
+  and wait_for_position(timeout) / trigger.add_callback() react to the 
+  magnet as soon as INT changes.  INT must be set up (once, in EEPROM) 
+  with the Z threshold and latching disabled, so it follows the field.
+
+  start_sampling(rate=sensor_sampler.SAMPLE_RATE, **kwargs)
+    - Read the sensor on a background SensorSampler thread with median, 
+      hysteresis (HALL_THRESHOLD on, HALL_RELEASE off) and debounce 
+      filtering.  in_position() and wait_for_position() then use the 
+      cached, filtered state; sampler.stats() gives windowed statistics.
+      Filtering adds a few sample periods of delay, so the stepper's 
+      homing / stall checks are sharper with direct reads or interrupts.
+
+--------------------------------------------------------------------------
+Background Information:
+
+  * ALS31300 datasheet:
+    * https://www.allegromicro.com/-/media/files/datasheets/als31300-datasheet.pdf
 
 """
 import time
 import random
+
+import i2c_bus
+import gpio_events
+import sensor_sampler
+
 # ------------------------------------------------------------------------
 # Constants
 # ------------------------------------------------------------------------
 
+BACKEND_I2C                 = "i2c"
+BACKEND_SIMULATED           = "simulated"
 
+# ALS31300 registers
+ALS31300_ACCESS_REG         = 0x35
+ALS31300_ACCESS_CODE        = 0x2C413534        # Customer write access
+ALS31300_POWER_REG          = 0x27
+ALS31300_POWER_ACTIVE       = 0x00000000        # Active mode, single read
+                                                # I2C loop mode (bits 3:2 = 00)
+ALS31300_FIELD_REG          = 0x28              # 0x28 MSBs, 0x29 LSBs
+ALS31300_FIELD_SIZE         = 8
 
+HALL_THRESHOLD              = 200               # |Z| counts (12-bit)
+HALL_RELEASE                = 150               # |Z| below which it is off
 
 # ------------------------------------------------------------------------
 # Global variables
@@ -58,33 +111,149 @@ class HallEffectSensor():
     """ HallEffectSensor """
     hall_effect_bus          = None
     hall_effect_address      = None
+    backend                  = None
+    device                   = None
+    trigger                  = None
+    sampler                  = None
     
-    def __init__(self, hall_effect_bus = 1, hall_effect_address = 0x60):
+    def __init__(self, hall_effect_bus = 1, hall_effect_address = 0x60,
+                 backend = BACKEND_I2C, interrupt_pin = None, events = None):
         """ Initialize variables and set up display """
         self.hall_effect_bus      = hall_effect_bus
         self.hall_effect_address  = hall_effect_address
+        self.backend              = backend
         
         self._setup()
+        
+        # INT is open drain, active low
+        if (interrupt_pin is not None) and (self.backend == BACKEND_I2C):
+            if events is None:
+                events = gpio_events.default_events()
+            
+            self.trigger = events.watch(interrupt_pin, gpio_events.EDGE_BOTH, 
+                                        active_low=True)
     # End def
 
     def _setup(self):
         """Setup the hardware components."""
-        pass
+        if self.backend == BACKEND_SIMULATED:
+            return
+        
+        if self.backend != BACKEND_I2C:
+            raise ValueError("Unknown hall effect backend {0}".format(self.backend))
+        
+        try:
+            # Shared /dev/i2c-N only (i2cget cannot do burst reads); sensor
+            # reads go ahead of display refreshes
+            self.device = i2c_bus.open_shared(self.hall_effect_bus, 
+                                              self.hall_effect_address,
+                                              i2c_bus.PRIORITY_SENSOR)
+            
+            self._write_register(ALS31300_ACCESS_REG, ALS31300_ACCESS_CODE)
+            self._write_register(ALS31300_POWER_REG, ALS31300_POWER_ACTIVE)
+        except (OSError, IOError) as error:
+            print("Could not set up hall effect sensor ({0}); using simulated readings".format(error))
+            self.cleanup()
+            self.backend = BACKEND_SIMULATED
+    # End def
+
+    def _write_register(self, register, value):
+        """ Write a 32-bit register (MSB first) """
+        self.device.write(bytes([register]) + value.to_bytes(4, "big"))
+    # End def
+
+    def read_field(self):
+        """ Returns the (x, y, z) field in signed 12-bit counts
+        
+        Registers 0x28 (MSBs) and 0x29 (LSBs) are read in one transaction,
+        so all three axes come from the same conversion.
+        """
+        if self.backend == BACKEND_SIMULATED:
+            z = random.choice((0, 2 * HALL_THRESHOLD))
+            return (0, 0, z)
+        
+        data = self.device.write_read([ALS31300_FIELD_REG], ALS31300_FIELD_SIZE)
+        
+        x = (data[0] << 4) | (data[5] & 0x0F)
+        y = (data[1] << 4) | (data[6] >> 4)
+        z = (data[2] << 4) | (data[6] & 0x0F)
+        
+        return tuple(value - 4096 if value & 0x800 else value 
+                     for value in (x, y, z))
     # End def
 
+    def start_sampling(self, rate = sensor_sampler.SAMPLE_RATE, **kwargs):
+        """ Sample the sensor on a background thread; Returns the sampler """
+        if self.sampler is None:
+            self.sampler = sensor_sampler.SensorSampler(
+                lambda: abs(self.read_field()[2]), HALL_THRESHOLD, HALL_RELEASE,
+                rate = rate, **kwargs)
+            self.sampler.start()
+        
+        return self.sampler
+    # End def
 
     def in_position(self):
         """ Checks whether is magnet is over hall effect sensor"""
-        val = random.random()
-        if val > 0.5:
+        if self.trigger is not None:
+            if self.trigger.active:
+                return 1
+            else:
+                return 0
+        
+        if self.sampler is not None:
+            if self.sampler.latest():
+                return 1
+            else:
+                return 0
+        
+        if self.backend == BACKEND_SIMULATED:
+            val = random.random()
+            if val > 0.5:
+                return 1
+            else:
+                return 0
+        
+        if abs(self.read_field()[2]) > HALL_THRESHOLD:
             return 1
         else:
             return 0
     # End def
 
+    def wait_for_position(self, timeout = None):
+        """ Waits until the magnet is over the sensor; Returns False on timeout
+        
+        Without an interrupt pin or a sampler this can only check the 
+        sensor once.
+        """
+        if self.trigger is None:
+            if self.sampler is not None:
+                return self.sampler.wait_for(True, timeout)
+            
+            return bool(self.in_position())
+        
+        end = None if timeout is None else time.monotonic() + timeout
+        
+        while not self.trigger.active:
+            remaining = None if end is None else end - time.monotonic()
+            
+            if (remaining is not None) and (remaining <= 0):
+                return False
+            
+            self.trigger.wait(remaining)
+        
+        return True
+    # End def
+
     def cleanup(self):
         """Cleanup the hardware components."""
-        pass
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        
+        if self.device is not None:
+            self.device.close()
+            self.device = None
         
     # End def
 
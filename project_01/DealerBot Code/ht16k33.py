@@ -33,9 +33,18 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 --------------------------------------------------------------------------
 Software API:
 
-  HT16K33(bus, address=0x70)
+  HT16K33(bus, address=0x70, backend=i2c_bus.BACKEND_DEV, 
+          async_mode=False, max_refresh_rate=MAX_REFRESH_RATE)
     - Provide i2c bus that dispaly is on
     - Provide i2c address for the display
+    - Provide i2c backend ("dev" keeps /dev/i2c-<bus> open, "i2cset" 
+      spawns /usr/sbin/i2cset for every write)
+    - With "dev" the display shares the bus through i2c_bus.get_bus() at
+      PRIORITY_DISPLAY, so sensor reads on the same bus go first
+    - If async_mode is True, display writes are posted to a background 
+      writer thread and return immediately.  The writer only sends the 
+      latest frame posted and refreshes at most max_refresh_rate times 
+      per second.
     
     clear()
       - Sets value of display to "0000"
@@ -53,6 +62,143 @@ Software API:
       - Update the value on the display with text.
         The following characters are supported:
             "abcdefghijlnopqrstuyABCDEFGHIJLNOPQRSTUY? -"
+
+    scroll(message, rate=SCROLL_RATE, loop=False)
+      - Scroll a message of any length across the display in the 
+        background.  The message uses the same characters as text().  A new
+        scroll(), update(), text(), set_digit(), set_digit_raw(), 
+        set_colon(), clear() or blank() cancels the scroll.
+
+    stop_scroll()
+      - Cancel a running scroll
+
+    flush()
+      - Wait until the latest frame has been written to the display
+        (only needed in async mode)
+
+    close()
+      - Flush and stop the writer thread; Release the i2c bus handle
+
+  Key scan:
+
+    The HT16K33 scans up to 39 keys (3 KS lines x 13 K lines) by itself.  
+    Keys are numbered KS * 13 + K.
+
+    start_key_scan(rate=KEY_SCAN_RATE, debounce=KEY_DEBOUNCE_SAMPLES,
+                   interrupt=None)
+      - Start a KeyScanner.  Returns the KeyScanner (also display.keys).
+      - ROW15 is switched to the active low INT output.  interrupt may be
+        a gpio_events PinWatch on that pin (active_low=True): while no key
+        is down the scanner then sleeps until INT goes active and puts no
+        traffic on the bus.
+      - Without interrupt, the scanner reads the one byte INT flag register
+        (0x60) rate times per second while no key is down, and only reads
+        key RAM once the flag is set.
+      - While any key is down, all of key RAM is read in one transaction 
+        rate times per second, so releases are seen and debounced.
+
+  KeyScanner(display, rate=KEY_SCAN_RATE, debounce=KEY_DEBOUNCE_SAMPLES,
+             interrupt=None)
+    - A key change is reported after it is seen in debounce samples in a row
+
+    on_press(callback) / on_release(callback)
+      - Call callback(key) from the scan thread when a key changes
+
+    pressed()
+      - Returns the list of keys that are currently pressed (debounced)
+
+    wait_for_press(key=None, timeout=None)
+      - Wait for a key (or any key) to be pressed; Returns the key or None
+        on timeout
+
+    stop()
+      - Stop the scan thread
+
+  Marquee(display, rate=SCROLL_RATE)
+    - Scrolling text engine used by HT16K33.scroll()
+
+    start(message, loop=False)
+      - Cancel any running message; Render and play message in a thread
+
+    render(message, loop=False)
+      - Returns the list of four byte frames for message
+
+    stop()
+      - Cancel the running message
+
+    wait(timeout=None)
+      - Wait for a non-looping message to finish; Returns True if done
+
+  HT16K33Group(bus, addresses=GROUP_ADDRESSES, backend=i2c_bus.BACKEND_DEV,
+               max_refresh_rate=MAX_REFRESH_RATE)
+    - Manage several displays (one per address) on one i2c bus
+    - Display writes are posted to a shared writer thread that, once per 
+      refresh period, writes every changed display in address order in a 
+      single pass over the bus
+
+    group[index]
+      - The HT16K33 for the index-th address; its update(), text(), etc. 
+        are scheduled by the group
+
+    update(values) / text(values)
+      - Update every display; values[i] goes to group[i]
+
+    flush()
+      - Wait until every posted frame has been written
+
+    close()
+      - Flush; Stop the writer thread; Close every display
+
+  Encoding helpers:
+
+    encode_value(value)
+      - Returns the four segment bytes for a value between 0 and 9999 from
+        the precomputed VALUE_SEGMENTS table
+
+    encode_text(value)
+      - Returns the four segment bytes for a string of 1 to 4 characters.
+        Results are kept in an LRU cache of TEXT_CACHE_SIZE frames.
+
+    encode_benchmark(count=10000)
+      - Compare encodes per second of the table / cache lookups against 
+        the per-digit encode path
+
+  Framebuffer API:
+    
+    The display keeps a copy of the 16 byte display RAM in buffer.  clear(), 
+    blank(), update() and text() build the whole frame in memory and push it 
+    to the display with a single auto-incrementing block write, so the 
+    display never shows a partially written frame.
+
+    set_buffer_raw(digit_number, data)
+      - Set a digit in the framebuffer using a raw segment value
+
+    set_buffer_colon(enable)
+      - Turns on / off the colon in the framebuffer
+
+    clear_buffer()
+      - Turns off all LEDs in the framebuffer
+
+    write_display()
+      - Write the framebuffer to the display in one transaction.  Only the
+        bytes that differ from the last frame written are sent; if nothing
+        changed, no transaction is issued.
+
+    invalidate()
+      - Forget what is on the display so the next write sends every byte
+
+    writes_issued / writes_suppressed
+      - Number of display writes sent to the bus / skipped because the 
+        display already showed the requested frame
+
+    frames_coalesced
+      - Number of frames replaced by a newer frame before the writer 
+        thread sent them (async mode only)
+
+    write_errors
+      - Number of frames the writer thread could not send (bus errors are
+        counted and the frame dropped, so the thread keeps running; the 
+        next frame is then sent in full)
   
 --------------------------------------------------------------------------
 Background Information: 
@@ -73,7 +219,12 @@ Background Information:
         * https://en.wikichip.org/wiki/seven-segment_display/representing_letters
         
 """
-import os
+import time
+import threading
+import functools
+import itertools
+
+import i2c_bus
 
 
 # ------------------------------------------------------------------------
@@ -133,6 +284,27 @@ POINT_VALUE                 = 0x80
 
 DIGIT_ADDR                  = [0x00, 0x02, 0x06, 0x08]
 COLON_ADDR                  = 0x04
+COLON_VALUE                 = 0x02
+
+DISPLAY_RAM_ADDR            = 0x00
+DISPLAY_RAM_SIZE            = 16
+
+MAX_REFRESH_RATE            = 50                # Display refreshes per second
+FLUSH_CHECK_TIME            = 0.1               # Writer thread liveness check in flush() (s)
+
+NUM_DIGITS                  = 4
+MAX_VALUE                   = 9999
+TEXT_CACHE_SIZE             = 64
+
+SCROLL_RATE                 = 4                 # Marquee frames per second
+
+GROUP_ADDRESSES             = [0x70, 0x71, 0x72, 0x73, 0x74, 0x75, 0x76, 0x77]
+
+# Segment bytes for every value 0 - 9999; digits of value are at
+# VALUE_SEGMENTS[value * 4 : value * 4 + 4].  itertools.product counts in 
+# the same order as the decimal values, so the table is built in one pass.
+VALUE_SEGMENTS              = bytes(itertools.chain.from_iterable(
+                                  itertools.product(HEX_DIGITS[:10], repeat=NUM_DIGITS)))
 
 HT16K33_BLINK_CMD           = 0x80
 HT16K33_BLINK_DISPLAYON     = 0x01
@@ -148,24 +320,145 @@ HT16K33_BRIGHTNESS_CMD      = 0xE0
 HT16K33_BRIGHTNESS_HIGHEST  = 0x0F
 HT16K33_BRIGHTNESS_DARKEST  = 0x00
 
+HT16K33_ROWINT_CMD          = 0xA0
+HT16K33_ROWINT_INT          = 0x01
+HT16K33_ROWINT_ACT_HIGH     = 0x02
+
+KEY_RAM_ADDR                = 0x40
+KEY_INT_FLAG_ADDR           = 0x60              # Non zero once key data is set
+KEY_IDLE_CHECK_TIME         = 0.5               # stop() check while waiting on INT (s)
+KEY_RAM_SIZE                = 6
+KEYS_PER_ROW                = 13
+KEY_ROW_MASK                = 0x1FFF
+
+KEY_SCAN_RATE               = 100               # Key RAM reads per second
+KEY_DEBOUNCE_SAMPLES        = 3
+
 
 # ------------------------------------------------------------------------
 # Functions / Classes
 # ------------------------------------------------------------------------
+def encode_value(value):
+    """Return the four segment bytes for a value between 0 and 9999
+    
+    Will throw a ValueError if number is not between 0 and 9999.
+    """
+    if (value < 0) or (value > MAX_VALUE):
+        raise ValueError("Value must be between 0 and {0}.".format(MAX_VALUE))
+    
+    offset = value * NUM_DIGITS
+    return VALUE_SEGMENTS[offset:offset + NUM_DIGITS]
+
+# End def
+
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def encode_text(value):
+    """Return the four segment bytes for a string of 1 to 4 characters
+    
+    Unused digits are blank.  Will throw a ValueError if there are not the 
+    appropriate number of characters or if characters are used that are 
+    not supported.
+    """
+    if ((len(value) < 1) or (len(value) > NUM_DIGITS)):
+        raise ValueError("Must have between 1 and 4 characters")
+    
+    frame = bytearray(NUM_DIGITS)
+    
+    for i, char in enumerate(value):
+        if char not in LETTERS:
+            raise ValueError("Character {0} not supported".format(char))
+        
+        frame[i] = LETTERS[char]
+    
+    return bytes(frame)
+
+# End def
+
+
+def encode_benchmark(count=10000):
+    """Compare encodes per second of the lookup tables and the digit path
+    
+    Returns a dictionary of encodes per second for each method.
+    """
+    display = HT16K33.__new__(HT16K33)
+    values  = [i % (MAX_VALUE + 1) for i in range(count)]
+    words   = ["po", "UUar", "flop", "turn", "ri", "ga"]
+    texts   = [words[i % len(words)] for i in range(count)]
+    results = {}
+    
+    start = time.perf_counter()
+    for value in values:
+        [display.encode(value // 1000), display.encode((value % 1000) // 100),
+         display.encode((value % 100) // 10), display.encode(value % 10)]
+    results["value (digits)"] = count / (time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    for value in values:
+        encode_value(value)
+    results["value (table)"] = count / (time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    for value in texts:
+        [LETTERS[char] for char in value]
+    results["text (letters)"] = count / (time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    for value in texts:
+        encode_text(value)
+    results["text (cache)"] = count / (time.perf_counter() - start)
+    
+    return results
+
+# End def
+
+
 class HT16K33():
     """ Class to manage a HT16K33 I2C display """
     # Class variables
     bus     = None
     address = None
-    command = None
+    device  = None
+    buffer  = None
+    shadow  = None
+    
+    writes_issued     = 0
+    writes_suppressed = 0
+    frames_coalesced  = 0
+    write_errors      = 0
+    
+    # Scrolling text
+    marquee           = None
+    
+    # HT16K33Group that schedules writes for this display
+    group             = None
+    
+    # KeyScanner reading the key matrix
+    keys              = None
+    
+    # Async writer
+    async_mode        = False
+    refresh_period    = None
+    pending           = None
+    busy              = False
+    stopping          = False
+    condition         = None
+    writer            = None
     
-    def __init__(self, bus, address=0x70, blink=HT16K33_BLINK_OFF, brightness=HT16K33_BRIGHTNESS_HIGHEST):
+    def __init__(self, bus, address=0x70, blink=HT16K33_BLINK_OFF, brightness=HT16K33_BRIGHTNESS_HIGHEST,
+                 backend=i2c_bus.BACKEND_DEV, async_mode=False, max_refresh_rate=MAX_REFRESH_RATE):
         """ Initialize class variables; Set up display; Set display to blank """
         
         # Initialize class variables
         self.bus = bus
         self.address = address
-        self.command = "/usr/sbin/i2cset -y {0} {1}".format(bus, address)
+        self.device = i2c_bus.open_device(bus, address, backend, i2c_bus.PRIORITY_DISPLAY)
+        self.buffer = bytearray(DISPLAY_RAM_SIZE)
+        self.shadow = None
+        self.writes_issued = 0
+        self.writes_suppressed = 0
+        self.frames_coalesced = 0
+        self.write_errors = 0
         
         # Set up display
         self.setup(blink, brightness)
@@ -173,20 +466,175 @@ class HT16K33():
         # Set display to blank
         self.blank()
         
+        # Start the writer thread
+        if async_mode:
+            self.start_writer(max_refresh_rate)
+        
+    # End def
+    
+    def start_writer(self, max_refresh_rate=MAX_REFRESH_RATE):
+        """Start the background writer thread used in async mode"""
+        if max_refresh_rate <= 0:
+            raise ValueError("Refresh rate must be greater than 0")
+        
+        self.refresh_period = 1.0 / max_refresh_rate
+        self.pending        = None
+        self.busy           = False
+        self.stopping       = False
+        self.condition      = threading.Condition()
+        
+        self.writer = threading.Thread(target=self._writer_loop, name="ht16k33-writer")
+        self.writer.daemon = True
+        self.async_mode = True
+        self.writer.start()
+        
     # End def
     
     def setup(self, blink, brightness):
         """Initialize the display itself"""
         # i2cset -y 1 0x70 0x21
-        os.system("{0} {1}".format(self.command, (HT16K33_SYSTEM_SETUP | HT16K33_OSCILLATOR)))
+        self.device.write([HT16K33_SYSTEM_SETUP | HT16K33_OSCILLATOR])
         # i2cset -y 1 0x70 0x81
-        os.system("{0} {1}".format(self.command, (HT16K33_BLINK_CMD | blink | HT16K33_BLINK_DISPLAYON)))
+        self.device.write([HT16K33_BLINK_CMD | blink | HT16K33_BLINK_DISPLAYON])
         # i2cset -y 1 0x70 0xEF
-        os.system("{0} {1}".format(self.command, (HT16K33_BRIGHTNESS_CMD | brightness)))
+        self.device.write([HT16K33_BRIGHTNESS_CMD | brightness])
 
     # End def    
 
 
+    def flush(self):
+        """Wait until the latest posted frame is on the display"""
+        if self.group is not None:
+            self.group.flush()
+            return
+        
+        if not self.async_mode:
+            return
+        
+        # Stop waiting if the writer thread is gone, or this never returns
+        with self.condition:
+            while ((self.pending is not None) or self.busy) and self.writer.is_alive():
+                self.condition.wait(FLUSH_CHECK_TIME)
+
+    # End def
+
+
+    def scroll(self, message, rate=SCROLL_RATE, loop=False):
+        """Scroll a message across the display without blocking"""
+        if self.marquee is None:
+            self.marquee = Marquee(self, rate)
+        
+        self.marquee.rate = rate
+        self.marquee.start(message, loop)
+
+    # End def
+
+
+    def stop_scroll(self):
+        """Cancel a running scroll"""
+        if self.marquee is not None:
+            self.marquee.stop()
+
+    # End def
+
+
+    def start_key_scan(self, rate=KEY_SCAN_RATE, debounce=KEY_DEBOUNCE_SAMPLES,
+                       interrupt=None):
+        """Start reading the key scan matrix in the background"""
+        if self.keys is not None:
+            self.keys.stop()
+        
+        # Use the ROW15/INT pin as an active low key interrupt output; the 
+        # INT flag register follows it, so it helps even with the pin unwired
+        self.device.write([HT16K33_ROWINT_CMD | HT16K33_ROWINT_INT])
+        
+        self.keys = KeyScanner(self, rate, debounce, interrupt)
+        self.keys.start()
+        
+        return self.keys
+
+    # End def
+
+
+    def read_key_flag(self):
+        """Read the INT flag register; Returns True if key data is set"""
+        return self.device.write_read([KEY_INT_FLAG_ADDR], 1)[0] != 0
+
+    # End def
+
+
+    def read_keys(self):
+        """Burst read key RAM; Returns a bit mask of the pressed keys"""
+        data = self.device.write_read([KEY_RAM_ADDR], KEY_RAM_SIZE)
+        mask = 0
+        
+        for row in range(KEY_RAM_SIZE // 2):
+            bits = (data[2 * row] | (data[2 * row + 1] << 8)) & KEY_ROW_MASK
+            mask = mask | (bits << (KEYS_PER_ROW * row))
+        
+        return mask
+
+    # End def
+
+
+    def close(self):
+        """Stop the writer thread; Release the i2c bus handle"""
+        self.stop_scroll()
+        
+        if self.keys is not None:
+            self.keys.stop()
+        
+        if self.async_mode:
+            self.flush()
+            
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            
+            self.writer.join()
+            self.async_mode = False
+        
+        self.device.close()
+
+    # End def
+
+
+    def _writer_loop(self):
+        """Write the latest posted frame, at most once per refresh period"""
+        next_time = time.monotonic()
+        
+        while True:
+            with self.condition:
+                while (self.pending is None) and not self.stopping:
+                    self.condition.wait()
+                
+                if self.pending is None:
+                    break
+
+            # Wait out the refresh period; newer frames replace the pending one
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.condition:
+                frame        = self.pending
+                self.pending = None
+                self.busy    = True
+            
+            try:
+                self._write_frame(frame)
+            except (OSError, IOError) as error:
+                self._write_failed(error)
+            finally:
+                next_time = time.monotonic() + self.refresh_period
+                
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    # End def
+
+
     def encode(self, data, double_point=False):
         """Encode data to TM1637 format.
         
@@ -198,64 +646,165 @@ class HT16K33():
         """
         ret_val = 0
         
-        try:
-            if (data != CLEAR_DIGIT):
-                if double_point:
-                    ret_val = HEX_DIGITS[data] + POINT_VALUE
-                else:
-                    ret_val = HEX_DIGITS[data]
-        except:
-            raise ValueError("Digit value must be between 0 and 15.")
+        if (data != CLEAR_DIGIT):
+            if (data < 0) or (data >= len(HEX_DIGITS)):
+                raise ValueError("Digit value must be between 0 and 15.")
+            
+            if double_point:
+                ret_val = HEX_DIGITS[data] + POINT_VALUE
+            else:
+                ret_val = HEX_DIGITS[data]
     
         return ret_val
 
     # End def
 
 
+    def set_buffer_raw(self, digit_number, data):
+        """Update the given digit of the framebuffer using raw data value"""
+        self.buffer[DIGIT_ADDR[digit_number]] = data
+
+    # End def
+
+
+    def set_buffer_frame(self, frame):
+        """Update all four digits of the framebuffer from raw data values"""
+        buffer = self.buffer
+        
+        buffer[DIGIT_ADDR[0]] = frame[0]
+        buffer[DIGIT_ADDR[1]] = frame[1]
+        buffer[DIGIT_ADDR[2]] = frame[2]
+        buffer[DIGIT_ADDR[3]] = frame[3]
+
+    # End def
+
+
+    def set_buffer_colon(self, enable):
+        """Set the colon in the framebuffer."""
+        if enable:
+            self.buffer[COLON_ADDR] = COLON_VALUE
+        else:
+            self.buffer[COLON_ADDR] = 0x00
+
+    # End def
+
+
+    def clear_buffer(self):
+        """Turn off all LEDs in the framebuffer"""
+        for i in range(DISPLAY_RAM_SIZE):
+            self.buffer[i] = 0x00
+
+    # End def
+
+
+    def invalidate(self):
+        """Forget the contents of the display so the next write is complete"""
+        self.shadow = None
+
+    # End def
+
+
+    def write_display(self):
+        """Write the framebuffer to the display (or post it in async mode)"""
+        if self.group is not None:
+            self.group.post(self, bytearray(self.buffer))
+        elif self.async_mode:
+            with self.condition:
+                if self.pending is not None:
+                    self.frames_coalesced += 1
+                
+                self.pending = bytearray(self.buffer)
+                self.condition.notify_all()
+        else:
+            self._write_frame(self.buffer)
+
+    # End def
+
+
+    def _write_failed(self, error):
+        """Count a failed background write; Resend everything next time
+        
+        The display may hold part of the frame, so the shadow is dropped.
+        """
+        self.write_errors += 1
+        self.shadow = None
+        
+        if self.write_errors == 1:
+            print("Display write failed ({0}); continuing".format(error))
+
+    # End def
+
+
+    def _write_frame(self, frame):
+        """Write the changed part of frame to display RAM
+        
+        The shadow holds the bytes last written to the display.  Only the 
+        span between the first and last changed byte is sent, using one 
+        auto-incrementing block write.
+        """
+        if self.shadow is None:
+            first = DISPLAY_RAM_ADDR
+            last  = DISPLAY_RAM_SIZE - 1
+        else:
+            changed = [i for i in range(DISPLAY_RAM_SIZE) if frame[i] != self.shadow[i]]
+
+            if not changed:
+                self.writes_suppressed += 1
+                return
+            
+            first = changed[0]
+            last  = changed[-1]
+
+        self.device.write(bytearray([first]) + frame[first:last + 1])
+        self.shadow = bytearray(frame)
+        self.writes_issued += 1
+
+    # End def
+
+
     def set_digit(self, digit_number, data, double_point=False):
         """Update the given digit of the display."""
-        os.system("{0} {1} {2}".format(self.command, DIGIT_ADDR[digit_number], self.encode(data, double_point)))    
+        self.set_digit_raw(digit_number, self.encode(data, double_point))
 
     # End def
 
 
     def set_digit_raw(self, digit_number, data, double_point=False):
         """Update the given digit of the display using raw data value"""
-        os.system("{0} {1} {2}".format(self.command, DIGIT_ADDR[digit_number], data))    
+        self.stop_scroll()
+        self.set_buffer_raw(digit_number, data)
+        self.write_display()
 
     # End def
 
 
     def set_colon(self, enable):
         """Set the colon on the display."""
-        if enable:
-            os.system("{0} {1} {2}".format(self.command, COLON_ADDR, 0x02))
-        else:
-            os.system("{0} {1} {2}".format(self.command, COLON_ADDR, 0x00))
+        self.stop_scroll()
+        self.set_buffer_colon(enable)
+        self.write_display()
 
     # End def        
 
 
     def blank(self):
         """Clear the display to read nothing"""
-        self.set_colon(False)
-
-        self.set_digit_raw(3, 0x00)
-        self.set_digit_raw(2, 0x00)
-        self.set_digit_raw(1, 0x00)
-        self.set_digit_raw(0, 0x00)
+        self.stop_scroll()
+        self.clear_buffer()
+        self.write_display()
 
     # End def
 
 
     def clear(self):
         """Clear the display to read '0000'"""
-        self.set_colon(False)
+        self.stop_scroll()
+        self.clear_buffer()
+
+        for i in range(len(DIGIT_ADDR)):
+            self.set_buffer_raw(i, self.encode(0))
 
-        self.set_digit(3, 0)
-        self.set_digit(2, 0)
-        self.set_digit(1, 0)
-        self.set_digit(0, 0)
+        self.write_display()
 
     # End def
 
@@ -269,15 +818,11 @@ class HT16K33():
         
         Will throw a ValueError if number is not between 0 and 9999.
         """
-        if (value < 0) or (value > 9999):
-            raise ValueError("Digit value must be between 0 and 15.")
-    
-        self.set_digit(0, value // 1000)    
-        self.set_digit(1, (value % 1000) // 100)    
-        self.set_digit(2, (value % 100) // 10) 
-        self.set_digit(3, (value % 10)) 
-            
-        # Modify code from ht16k33_func.py to implement this function
+        frame = encode_value(value)
+        
+        self.stop_scroll()
+        self.set_buffer_frame(frame)
+        self.write_display()
 
     # End def
     
@@ -289,23 +834,466 @@ class HT16K33():
         Will throw a ValueError if there are not the appropriate number of 
         characters or if characters are used that are not supported.
         """
-        if ((len(value) < 1) or (len(value) > 4)):
-            raise ValueError("Must have between 1 and 4 characters")        
+        # Translate the characters into the values needed for hex display
+        # before touching the framebuffer, so a bad character changes nothing
+        frame = encode_text(value)
+
+        # Build the frame and write it to the display in one transaction
+        self.stop_scroll()
+        self.set_buffer_colon(False)
+        self.set_buffer_frame(frame)
+        self.write_display()
+
+# End class
+
+
+class HT16K33Group():
+    """ Class to manage several HT16K33 I2C displays on one bus """
+    bus               = None
+    displays          = None
+    refresh_period    = None
+    
+    pending           = None
+    busy              = False
+    stopping          = False
+    condition         = None
+    writer            = None
+    
+    cycles            = 0
+    frames_coalesced  = 0
+    
+    def __init__(self, bus, addresses=GROUP_ADDRESSES, blink=HT16K33_BLINK_OFF, 
+                 brightness=HT16K33_BRIGHTNESS_HIGHEST, backend=i2c_bus.BACKEND_DEV, 
+                 max_refresh_rate=MAX_REFRESH_RATE):
+        """ Set up each display; Start the shared writer thread """
+        if max_refresh_rate <= 0:
+            raise ValueError("Refresh rate must be greater than 0")
         
-        # Clear the display
-        self.blank()
+        self.bus              = bus
+        self.displays         = []
+        self.refresh_period   = 1.0 / max_refresh_rate
+        self.pending          = {}
+        self.busy             = False
+        self.stopping         = False
+        self.condition        = threading.Condition()
+        self.cycles           = 0
+        self.frames_coalesced = 0
+        
+        for address in addresses:
+            display = HT16K33(bus, address, blink, brightness, backend)
+            display.group = self
+            self.displays.append(display)
+        
+        self.writer = threading.Thread(target=self._writer_loop, name="ht16k33-group-writer")
+        self.writer.daemon = True
+        self.writer.start()
+    
+    # End def
+
+
+    def __getitem__(self, index):
+        """Return the display at index"""
+        return self.displays[index]
+
+    # End def
+
+
+    def __len__(self):
+        """Return the number of displays"""
+        return len(self.displays)
+
+    # End def
+
+
+    def update(self, values):
+        """Update every display with a number; values[i] goes to display i"""
+        for display, value in zip(self.displays, values):
+            display.update(value)
+
+    # End def
+
+
+    def text(self, values):
+        """Update every display with text; values[i] goes to display i"""
+        for display, value in zip(self.displays, values):
+            display.text(value)
+
+    # End def
+
+
+    def post(self, display, frame):
+        """Schedule frame to be written to display in the next cycle"""
+        with self.condition:
+            if display in self.pending:
+                self.frames_coalesced += 1
+            
+            self.pending[display] = frame
+            self.condition.notify_all()
+
+    # End def
+
+
+    def flush(self):
+        """Wait until every posted frame has been written"""
+        with self.condition:
+            while (self.pending or self.busy) and self.writer.is_alive():
+                self.condition.wait(FLUSH_CHECK_TIME)
 
-        # Set the display to the correct characters        
-        for i, char in enumerate(value):
+    # End def
+
+
+    def close(self):
+        """Flush; Stop the writer thread; Close every display"""
+        self.flush()
+        
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        
+        self.writer.join()
+        
+        for display in self.displays:
+            display.group = None
+            display.close()
+
+    # End def
+
+
+    def _writer_loop(self):
+        """Once per refresh period, write every changed display in one pass"""
+        next_time = time.monotonic()
+        
+        while True:
+            with self.condition:
+                while (not self.pending) and not self.stopping:
+                    self.condition.wait()
+                
+                if not self.pending:
+                    break
+            
+            # Wait out the refresh period so updates to all displays batch up
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            
+            with self.condition:
+                batch        = self.pending
+                self.pending = {}
+                self.busy    = True
+            
             try:
-                # Translate the character into the value needed for hex display
-                self.set_digit_raw(i, LETTERS[char])
+                # Address order keeps each pass over the bus the same; one 
+                # display failing does not stop the others
+                for display in sorted(batch, key=lambda d: d.address):
+                    try:
+                        display._write_frame(batch[display])
+                    except (OSError, IOError) as error:
+                        display._write_failed(error)
+                
+                self.cycles += 1
+            finally:
+                next_time = time.monotonic() + self.refresh_period
                 
-                # Set the display digit with the character value
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    # End def
+
+# End class
+
+
+class KeyScanner():
+    """ Debounced key events from the HT16K33 key scan matrix """
+    display           = None
+    period            = None
+    debounce          = None
+    
+    state             = 0
+    press_callbacks   = None
+    release_callbacks = None
+    condition         = None
+    cancel            = None
+    thread            = None
+    interrupt         = None
+    
+    def __init__(self, display, rate=KEY_SCAN_RATE, debounce=KEY_DEBOUNCE_SAMPLES,
+                 interrupt=None):
+        """ Initialize class variables """
+        if rate <= 0:
+            raise ValueError("Key scan rate must be greater than 0")
+        
+        if debounce < 1:
+            raise ValueError("Debounce must be at least 1 sample")
+        
+        self.display           = display
+        self.period            = 1.0 / rate
+        self.debounce          = debounce
+        self.state             = 0
+        self.press_callbacks   = []
+        self.release_callbacks = []
+        self.condition         = threading.Condition()
+        self.cancel            = threading.Event()
+        self.thread            = None
+        self.interrupt         = interrupt
+    
+    # End def
+
+
+    def on_press(self, callback):
+        """Call callback(key) when a key is pressed"""
+        self.press_callbacks.append(callback)
+
+    # End def
+
 
+    def on_release(self, callback):
+        """Call callback(key) when a key is released"""
+        self.release_callbacks.append(callback)
+
+    # End def
+
+
+    def pressed(self):
+        """Return the list of keys that are currently pressed"""
+        state = self.state
+        return [key for key in range(KEYS_PER_ROW * KEY_RAM_SIZE // 2) if state & (1 << key)]
+
+    # End def
+
+
+    def wait_for_press(self, key=None, timeout=None):
+        """Wait for key (or any key) to be pressed
+        
+        Returns the key that was pressed, or None on timeout.
+        """
+        pressed = []
+        
+        def _pressed(k):
+            if (key is None) or (k == key):
+                with self.condition:
+                    pressed.append(k)
+                    self.condition.notify_all()
+        
+        self.on_press(_pressed)
+        
+        try:
+            with self.condition:
+                self.condition.wait_for(lambda: pressed, timeout)
+        finally:
+            self.press_callbacks.remove(_pressed)
+        
+        if pressed:
+            return pressed[0]
+        
+        return None
+
+    # End def
+
+
+    def start(self):
+        """Start the scan thread"""
+        self.cancel.clear()
+        
+        self.thread = threading.Thread(target=self._scan_loop, name="ht16k33-keyscan")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # End def
+
+
+    def stop(self):
+        """Stop the scan thread"""
+        if self.thread is None:
+            return
+        
+        self.cancel.set()
+        self.thread.join()
+        self.thread = None
+
+    # End def
+
+
+    def _scan_loop(self):
+        """Read key RAM at a fixed rate; Report changes that pass the debounce
+        
+        While no key is down (or about to be reported), wait on the INT pin
+        or only read the INT flag, so an idle key matrix costs little or no
+        bus time.
+        """
+        start  = time.monotonic()
+        index  = 0
+        last   = self.state
+        stable = 0
+        
+        while True:
+            idle = (self.state == 0) and (last == 0)
+            
+            if idle and (self.interrupt is not None):
+                # Sleep until a key press drives INT active
+                while not self.interrupt.active:
+                    if self.cancel.is_set():
+                        return
+                    
+                    self.interrupt.wait(KEY_IDLE_CHECK_TIME)
+                
+                start = time.monotonic()
+                index = 0
+                
+                sample = self.display.read_keys()
+            elif idle and not self.display.read_key_flag():
+                sample = 0
+            else:
+                sample = self.display.read_keys()
+            
+            if sample == last:
+                stable += 1
+            else:
+                last   = sample
+                stable = 1
+            
+            if (stable >= self.debounce) and (sample != self.state):
+                changed    = sample ^ self.state
+                self.state = sample
                 
-            except:
+                for key in range(KEYS_PER_ROW * KEY_RAM_SIZE // 2):
+                    if changed & (1 << key):
+                        if sample & (1 << key):
+                            callbacks = self.press_callbacks
+                        else:
+                            callbacks = self.release_callbacks
+                        
+                        for callback in list(callbacks):
+                            callback(key)
+            
+            index += 1
+            
+            if self.cancel.wait(max(0.0, start + index * self.period - time.monotonic())):
+                break
+
+    # End def
+
+# End class
+
+
+class Marquee():
+    """ Scroll messages longer than four characters across a HT16K33 """
+    display   = None
+    rate      = None
+    thread    = None
+    cancel    = None
+    
+    def __init__(self, display, rate=SCROLL_RATE):
+        """ Initialize class variables """
+        self.display = display
+        self.rate    = rate
+        self.thread  = None
+        self.cancel  = None
+    
+    # End def
+
+
+    def render(self, message, loop=False):
+        """Render every frame of message through the LETTERS table
+        
+        A message of four characters or fewer is a single frame.  Otherwise 
+        the first frame shows the first four characters and the message 
+        scrolls left; a looping message wraps around, a single pass ends on
+        a blank display.
+        """
+        if len(message) <= NUM_DIGITS:
+            return [encode_text(message)]
+        
+        padded = message + " " * NUM_DIGITS
+        
+        if loop:
+            padded = padded + padded[:NUM_DIGITS]
+            count  = len(message) + NUM_DIGITS
+        else:
+            count  = len(message) + 1
+        
+        segments = [LETTERS[char] for char in padded]
+        
+        return [bytes(segments[i:i + NUM_DIGITS]) for i in range(count)]
+
+    # End def
+
+
+    def start(self, message, loop=False):
+        """Cancel any running message; Play message in the background
+        
+        Will throw a ValueError if the message is empty or uses characters
+        that are not supported.
+        """
+        if len(message) < 1:
+            raise ValueError("Must have at least 1 character")
+        
+        for char in message:
+            if char not in LETTERS:
                 raise ValueError("Character {0} not supported".format(char))
+        
+        if self.rate <= 0:
+            raise ValueError("Scroll rate must be greater than 0")
+        
+        self.stop()
+        
+        self.cancel = threading.Event()
+        self.thread = threading.Thread(target=self._play, name="ht16k33-marquee",
+                                       args=(message, loop, 1.0 / self.rate, self.cancel))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # End def
+
+
+    def stop(self):
+        """Cancel the running message"""
+        if self.thread is None:
+            return
+        
+        self.cancel.set()
+        
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        
+        self.thread = None
+
+    # End def
+
+
+    def wait(self, timeout=None):
+        """Wait for a non-looping message to finish"""
+        thread = self.thread
+        
+        if thread is None:
+            return True
+        
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    # End def
+
+
+    def _play(self, message, loop, period, cancel):
+        """Show each frame at an absolute deadline so the timing never drifts"""
+        frames = self.render(message, loop)
+        start  = time.monotonic()
+        index  = 0
+        
+        while True:
+            self.display.set_buffer_frame(frames[index % len(frames)])
+            self.display.write_display()
+            
+            index += 1
+            
+            if (not loop) and (index >= len(frames)):
+                break
+            
+            # Deadlines are measured from the start, so late wakeups do not add up
+            if cancel.wait(max(0.0, start + index * period - time.monotonic())):
+                break
+
+    # End def
 
 # End class
 
@@ -315,10 +1303,13 @@ class HT16K33():
 # ------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    import time
-
     delay = 0.1
     
+    print("Encode benchmark (encodes per second):")
+    
+    for name, rate in encode_benchmark().items():
+        print("    {0:<16} {1:>12,.0f}".format(name, rate))
+    
     print("Test HT16K33 Display:")
     
     display = HT16K33(1, 0x70)
@@ -359,5 +1350,23 @@ if __name__ == '__main__':
     display.set_colon(True)
     time.sleep(1)
 
+    display.scroll("HELLO - ready to deal")
+    display.marquee.wait()
+    
     display.clear()    
+    print("Display writes issued: {0}  suppressed: {1}".format(display.writes_issued, display.writes_suppressed))
+    display.close()
+
+    # Compare the i2c backends
+    for backend in [i2c_bus.BACKEND_DEV, i2c_bus.BACKEND_I2CSET]:
+        display = HT16K33(1, 0x70, backend=backend)
+
+        start = time.time()
+        for i in range(0, 100):
+            display.update(i)
+        elapsed = time.time() - start
+
+        print("{0:>6} backend:  {1:.2f} ms per update".format(backend, elapsed * 10.0))
+        display.close()
+
     print("Test Finished.")
\ No newline at end of file
@@ -0,0 +1,507 @@
+"""
+--------------------------------------------------------------------------
+I2C Bus
+--------------------------------------------------------------------------
+License:
+Copyright 2022 Abinand Parthasarathy
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+may be used to endorse or promote products derived from this software without
+specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+--------------------------------------------------------------------------
+Software API:
+
+  open_device(bus, address, backend=BACKEND_DEV, priority=PRIORITY_NORMAL)
+    - Returns a device object for the given i2c bus / address
+    - BACKEND_DEV goes through the shared I2CBus for the bus (see below)
+    - BACKEND_I2CSET spawns /usr/sbin/i2cset for every write
+    - If /dev/i2c-<bus> cannot be opened, falls back to BACKEND_I2CSET
+
+  open_shared(bus, address, priority=PRIORITY_NORMAL)
+    - Returns a device on the shared I2CBus; raises OSError if 
+      /dev/i2c-<bus> cannot be opened (no i2cset fallback)
+
+  get_bus(bus)
+    - Returns the I2CBus that owns /dev/i2c-<bus>, opening it on first use;
+      it is closed when the last device on it is closed
+
+  I2CBus objects own one /dev/i2c-N handle shared by every device on it:
+    - One transaction runs at a time.  Waiting transactions are served in
+      priority order (lower first: PRIORITY_SENSOR before PRIORITY_NORMAL
+      before PRIORITY_DISPLAY), oldest first within a priority.
+    - Transactions of the same priority queued while the bus was busy are
+      sent together in one I2C_RDWR ioctl (up to I2C_RDWR_MAX_MSGS 
+      messages, with repeated starts between them), so a burst of 
+      updates costs one system call.  If a batch fails, its transactions 
+      are retried one at a time, so only the failing ones raise.
+    - stats() returns per-address transaction, byte and busy time counts,
+      and totals for the bus.
+
+  Device objects provide:
+    write(data)
+      - Send the bytes in data as a single raw write transaction
+
+    write_read(data, length)
+      - Send data (e.g. a register address), then read length bytes back 
+        using a repeated start, as a single combined transaction
+
+    close()
+      - Release the bus handle
+
+--------------------------------------------------------------------------
+Background Information:
+
+  * Linux i2c-dev interface:
+    * https://www.kernel.org/doc/Documentation/i2c/dev-interface
+
+"""
+import os
+import time
+import fcntl
+import ctypes
+import heapq
+import itertools
+import threading
+import subprocess
+
+
+# ------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------
+
+I2C_DEV_PATH                = "/dev/i2c-{0}"
+I2C_RDWR                    = 0x0707            # ioctl from <linux/i2c-dev.h>
+I2C_M_RD                    = 0x0001            # i2c_msg read flag
+I2C_RDWR_MAX_MSGS           = 42                # I2C_RDWR_IOCTL_MAX_MSGS
+
+I2CSET_PATH                 = "/usr/sbin/i2cset"
+I2CGET_PATH                 = "/usr/sbin/i2cget"
+
+BACKEND_DEV                 = "dev"
+BACKEND_I2CSET              = "i2cset"
+
+PRIORITY_SENSOR             = 0                 # Latency critical reads
+PRIORITY_NORMAL             = 5
+PRIORITY_DISPLAY            = 10                # Display refreshes
+
+
+# ------------------------------------------------------------------------
+# Global variables
+# ------------------------------------------------------------------------
+
+_buses                      = {}
+_buses_lock                 = threading.Lock()
+
+
+# ------------------------------------------------------------------------
+# Functions / Classes
+# ------------------------------------------------------------------------
+
+class _I2CMsg(ctypes.Structure):
+    """ struct i2c_msg from <linux/i2c.h> """
+    _fields_ = [("addr",  ctypes.c_uint16),
+                ("flags", ctypes.c_uint16),
+                ("len",   ctypes.c_uint16),
+                ("buf",   ctypes.POINTER(ctypes.c_uint8))]
+
+# End class
+
+
+class _I2CRdwrData(ctypes.Structure):
+    """ struct i2c_rdwr_ioctl_data from <linux/i2c-dev.h> """
+    _fields_ = [("msgs",  ctypes.POINTER(_I2CMsg)),
+                ("nmsgs", ctypes.c_uint32)]
+
+# End class
+
+
+class I2CSetDevice():
+    """ Fallback device that spawns i2cset for every transaction """
+    bus     = None
+    address = None
+    command = None
+
+    def __init__(self, bus, address):
+        """ Build the i2cset command prefix """
+        self.bus     = bus
+        self.address = address
+        self.command = "{0} -y {1} {2}".format(I2CSET_PATH, bus, address)
+
+    # End def
+
+    def write(self, data):
+        """ Send data using i2cset
+
+        One byte is sent as a command, two bytes as a register / value pair
+        and anything longer as an i2c block write starting at data[0].
+        """
+        values = " ".join(str(value) for value in data)
+
+        if len(data) > 2:
+            os.system("{0} {1} i".format(self.command, values))
+        else:
+            os.system("{0} {1}".format(self.command, values))
+
+    # End def
+
+    def write_read(self, data, length):
+        """ Read length registers starting at data[0] using i2cget
+
+        i2cget reads one byte per call, so this is much slower than the
+        /dev/i2c-N device and is not a single transaction.
+        """
+        ret_val = bytearray()
+
+        for i in range(length):
+            output = subprocess.check_output([I2CGET_PATH, "-y", str(self.bus),
+                                              str(self.address), str(data[0] + i)])
+            ret_val.append(int(output.strip(), 16))
+
+        return bytes(ret_val)
+
+    # End def
+
+    def close(self):
+        """ Nothing to release """
+        pass
+
+    # End def
+
+# End class
+
+
+class _Transaction():
+    """ One queued write or write / read on an I2CBus """
+    priority = None
+    seq      = None
+    address  = None
+    data     = None
+    length   = None
+    result   = None
+    error    = None
+    done     = False
+
+    def __init__(self, priority, seq, address, data, length):
+        """ Initialize class variables """
+        self.priority = priority
+        self.seq      = seq
+        self.address  = address
+        self.data     = bytes(data)
+        self.length   = length
+        self.done     = False
+
+    # End def
+
+    def __lt__(self, other):
+        """ Order by priority, then by age """
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    # End def
+
+# End class
+
+
+class I2CBus():
+    """ Single owner of a /dev/i2c-N handle shared by several devices """
+    bus       = None
+    fd        = None
+    users     = 0
+    condition = None
+    queue     = None
+    busy      = False
+    counter   = None
+    devices   = None
+    ioctls    = 0
+    busy_time = 0.0
+
+    def __init__(self, bus):
+        """ Open the bus device once """
+        self.bus       = bus
+        self.fd        = os.open(I2C_DEV_PATH.format(bus), os.O_RDWR)
+        self.users     = 0
+        self.condition = threading.Condition()
+        self.queue     = []
+        self.busy      = False
+        self.counter   = itertools.count()
+        self.devices   = {}
+        self.ioctls    = 0
+        self.busy_time = 0.0
+
+    # End def
+
+    def device(self, address, priority=PRIORITY_NORMAL):
+        """ Returns a device handle for address that uses this bus """
+        return SharedDevice(self, address, priority)
+
+    # End def
+
+    def transfer(self, address, data, length=0, priority=PRIORITY_NORMAL):
+        """ Write data to address, then read length bytes if length > 0
+        
+        Blocks until the transaction is done; returns the bytes read.
+        """
+        transaction = _Transaction(priority, next(self.counter), address, data, length)
+
+        with self.condition:
+            heapq.heappush(self.queue, transaction)
+
+            # Another thread may send this transaction in its batch
+            self.condition.wait_for(lambda: transaction.done or 
+                                    (not self.busy and self.queue[0] is transaction))
+
+            if not transaction.done:
+                # Batch queued transactions of the same priority only, so 
+                # a sensor read never waits for display data in its ioctl
+                batch = [heapq.heappop(self.queue)]
+
+                while (self.queue and (len(batch) < I2C_RDWR_MAX_MSGS // 2) and
+                       (self.queue[0].priority == transaction.priority)):
+                    batch.append(heapq.heappop(self.queue))
+
+                self.busy = True
+
+        if not transaction.done:
+            try:
+                self._send(batch)
+            except BaseException as error:
+                # Anything but an I2C error (e.g. KeyboardInterrupt, or a 
+                # closed bus); free the bus so the other devices carry on
+                self._abort(batch, error)
+                raise
+
+        if transaction.error is not None:
+            raise transaction.error
+
+        return transaction.result
+
+    # End def
+
+    def _send(self, batch):
+        """ Send a batch of transactions in one I2C_RDWR ioctl
+        
+        If the batch fails, each transaction is retried on its own, so one
+        device that does not answer does not fail the others queued with it.
+        """
+        error, elapsed = self._rdwr(batch)
+        errors         = [error] * len(batch)
+        times          = [elapsed / len(batch)] * len(batch)
+        ioctls         = 1
+
+        if (error is not None) and (len(batch) > 1):
+            # The kernel stops at the failing message, so transactions ahead
+            # of it may be sent twice; they are register writes and reads, 
+            # so repeating them is harmless
+            for index, transaction in enumerate(batch):
+                errors[index], elapsed = self._rdwr([transaction])
+                times[index]          += elapsed
+                ioctls                += 1
+
+        with self.condition:
+            self.ioctls    += ioctls
+            self.busy_time += sum(times)
+
+            for transaction, error, elapsed in zip(batch, errors, times):
+                stats = self.devices.setdefault(transaction.address, 
+                                                {"transactions": 0, "bytes": 0, 
+                                                 "busy_time": 0.0, "errors": 0})
+                stats["transactions"] += 1
+                stats["bytes"]        += len(transaction.data) + transaction.length
+                stats["busy_time"]    += elapsed
+
+                if error is not None:
+                    stats["errors"]   += 1
+                    transaction.error  = error
+                    transaction.result = None
+                elif transaction.length:
+                    transaction.result = bytes(transaction.result)
+
+                transaction.done = True
+
+            self.busy = False
+            self.condition.notify_all()
+
+    # End def
+
+    def _abort(self, batch, error):
+        """ Finish the unfinished transactions of a batch with error; Free the bus """
+        if not isinstance(error, Exception):
+            error = OSError("I2C transfer aborted ({0!r})".format(error))
+
+        with self.condition:
+            for transaction in batch:
+                if not transaction.done:
+                    transaction.error  = error
+                    transaction.result = None
+                    transaction.done   = True
+
+            self.busy = False
+            self.condition.notify_all()
+
+    # End def
+
+    def _rdwr(self, batch):
+        """ Run one I2C_RDWR ioctl for batch; Returns (error or None, time) """
+        msgs    = []
+        buffers = []
+
+        for transaction in batch:
+            out_buf = (ctypes.c_uint8 * len(transaction.data))(*transaction.data)
+            buffers.append(out_buf)
+            msgs.append(_I2CMsg(transaction.address, 0, len(transaction.data), out_buf))
+
+            if transaction.length:
+                in_buf = (ctypes.c_uint8 * transaction.length)()
+                buffers.append(in_buf)
+                msgs.append(_I2CMsg(transaction.address, I2C_M_RD, transaction.length, in_buf))
+                transaction.result = in_buf
+
+        rdwr  = _I2CRdwrData((_I2CMsg * len(msgs))(*msgs), len(msgs))
+        start = time.monotonic()
+        error = None
+
+        try:
+            fcntl.ioctl(self.fd, I2C_RDWR, rdwr)
+        except (OSError, IOError) as exc:
+            error = exc
+
+        return (error, time.monotonic() - start)
+
+    # End def
+
+    def stats(self):
+        """ Returns per-address counts and totals for the bus
+        
+        busy_time is the time spent in the ioctl; a batch's time is split 
+        evenly between its transactions (plus the time of their own retry, 
+        if the batch failed).
+        """
+        with self.condition:
+            devices = dict((address, dict(stats)) 
+                           for address, stats in self.devices.items())
+
+            return {"devices"   : devices,
+                    "ioctls"    : self.ioctls,
+                    "busy_time" : self.busy_time,
+                    "transactions" : sum(stats["transactions"] 
+                                         for stats in devices.values())}
+
+    # End def
+
+    def close(self):
+        """ Release the bus handle """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # End def
+
+# End class
+
+
+class SharedDevice():
+    """ Device handle that sends its transactions through an I2CBus """
+    bus      = None
+    address  = None
+    priority = None
+
+    def __init__(self, bus, address, priority=PRIORITY_NORMAL):
+        """ Initialize class variables """
+        self.bus      = bus
+        self.address  = address
+        self.priority = priority
+
+    # End def
+
+    def write(self, data):
+        """ Send data as one write transaction """
+        self.bus.transfer(self.address, data, 0, self.priority)
+
+    # End def
+
+    def write_read(self, data, length):
+        """ Write data, then read length bytes, in one combined transaction """
+        return self.bus.transfer(self.address, data, length, self.priority)
+
+    # End def
+
+    def close(self):
+        """ Release this device's use of the bus """
+        if self.bus is not None:
+            _release_bus(self.bus)
+            self.bus = None
+
+    # End def
+
+# End class
+
+
+def get_bus(bus):
+    """ Returns the shared I2CBus for bus, opening it on first use """
+    with _buses_lock:
+        owner = _buses.get(bus)
+
+        if owner is None:
+            owner = I2CBus(bus)
+            _buses[bus] = owner
+
+        owner.users += 1
+        return owner
+
+# End def
+
+
+def _release_bus(owner):
+    """ Close the shared bus once its last device is closed """
+    with _buses_lock:
+        owner.users -= 1
+
+        if owner.users <= 0:
+            _buses.pop(owner.bus, None)
+            owner.close()
+
+# End def
+
+
+def open_shared(bus, address, priority=PRIORITY_NORMAL):
+    """ Return a device on the shared bus; Raises OSError if it cannot be opened """
+    return get_bus(bus).device(address, priority)
+
+# End def
+
+
+def open_device(bus, address, backend=BACKEND_DEV, priority=PRIORITY_NORMAL):
+    """ Return a device object for the given bus / address """
+    if backend == BACKEND_I2CSET:
+        return I2CSetDevice(bus, address)
+
+    if backend != BACKEND_DEV:
+        raise ValueError("Unknown i2c backend {0}".format(backend))
+
+    try:
+        return open_shared(bus, address, priority)
+    except (OSError, IOError):
+        print("Could not open {0}; using i2cset".format(I2C_DEV_PATH.format(bus)))
+        return I2CSetDevice(bus, address)
+
+# End def
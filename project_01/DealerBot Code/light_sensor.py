@@ -32,15 +32,94 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 --------------------------------------------------------------------------
 Simple class used to determine if the light sensor is activated or not
 
+Driver for the AMS TSL2591 light sensor (address 0x29).  The bus is opened
+once in _setup(); each sample reads the status and both ADC channels 
+(registers 0x13 - 0x17) in one 5 byte burst.  A card is in position when 
+it blocks the light, i.e. the full spectrum channel drops below 
+LIGHT_THRESHOLD.
+
+  LightSensor(light_bus=1, light_address=0x29, backend=BACKEND_I2C)
+    - BACKEND_I2C reads the sensor through the shared i2c_bus.I2CBus for 
+      /dev/i2c-<bus>, at PRIORITY_SENSOR; if it cannot be opened or set 
+      up, falls back to BACKEND_SIMULATED
+    - BACKEND_SIMULATED returns random readings so the rest of DealerBot 
+      can run without the hardware
+
+  read_channels()
+    - Returns (full spectrum, infrared) ADC counts
+
+  wait_for_card(timeout=None)
+    - Waits until a card blocks the light; Returns False on timeout.  
+      With interrupt_pin set, the TSL2591 is programmed to pull INT low 
+      when the full spectrum channel drops below LIGHT_THRESHOLD, and the
+      pin is watched with gpio_events (events, or the shared 
+      default_events()), so the wait takes no bus reads or polling.
+      Without it, the sampler is waited on if sampling, otherwise the 
+      sensor is read every POLL_TIME until the timeout.
+
+  wait_for_clear(timeout=None)
+    - Waits until the light is no longer blocked (the card has left); 
+      Returns False on timeout.  Always reads the sensor itself every 
+      POLL_TIME, even while sampling: the first conversion that sees 
+      light ends the wait, where the filtered state would lag by a few 
+      samples (the motor must be cut as soon as the card is out).
+
+  start_sampling(rate=LIGHT_SAMPLE_RATE, **kwargs)
+    - Read the sensor on a background SensorSampler thread with median, 
+      hysteresis (dark below LIGHT_THRESHOLD, light again above 
+      LIGHT_RELEASE) and debounce filtering, so one noisy reading cannot
+      decide whether a card is dealt.  in_position() and wait_for_card() 
+      then use the cached, filtered state; sampler.stats() gives windowed
+      statistics.
+    - The sensor only makes a new conversion every LIGHT_INTEGRATION_TIME,
+      so it is sampled at that rate (faster reads would fill the filters
+      with copies of the same conversion).  A median of 3 conversions 
+      already needs two to agree, so debounce defaults to 1 sample.
+
+--------------------------------------------------------------------------
+Background Information:
+
+  * TSL2591 datasheet:
+    * https://ams.com/documents/20143/36005/TSL2591_DS000338_6-00.pdf
+
 """
 import time
 import random
+import concurrent.futures
+
+import i2c_bus
+import gpio_events
+import sensor_sampler
+
 # ------------------------------------------------------------------------
 # Constants
 # ------------------------------------------------------------------------
 
+BACKEND_I2C                 = "i2c"
+BACKEND_SIMULATED           = "simulated"
+
+# TSL2591 registers (all accessed with the command bit set)
+TSL2591_COMMAND             = 0xA0              # Command, normal operation
+TSL2591_ENABLE_REG          = 0x00
+TSL2591_ENABLE_ON           = 0x03              # Power on, ALS enable
+TSL2591_CONTROL_REG         = 0x01
+TSL2591_CONTROL_VALUE       = 0x10              # Medium gain, 100 ms
+LIGHT_INTEGRATION_TIME      = 0.1               # Conversion time (s) set above
+LIGHT_SAMPLE_RATE           = 1 / LIGHT_INTEGRATION_TIME   # Hz
+LIGHT_DEBOUNCE_SAMPLES      = 1
+TSL2591_STATUS_REG          = 0x13              # Status, then C0 / C1 data
+TSL2591_STATUS_AVALID       = 0x01
+TSL2591_DATA_SIZE           = 5
+TSL2591_ENABLE_AIEN         = 0x10              # ALS interrupt enable
+TSL2591_AILTL_REG           = 0x04              # Low threshold, then high
+TSL2591_PERSIST_REG         = 0x0C
+TSL2591_PERSIST_EVERY       = 0x01              # Any value outside thresholds
+TSL2591_CLEAR_INT           = 0xE7              # Special function: clear ALS int
 
+LIGHT_THRESHOLD             = 100               # Full spectrum counts
+LIGHT_RELEASE               = 150               # Counts above which it is light
 
+POLL_TIME                   = 0.005             # Poll period without sampler (s)
 
 # ------------------------------------------------------------------------
 # Global variables
@@ -56,36 +135,199 @@ class LightSensor():
     """LightSensor """
     light_bus      = None
     light_address  = None
+    backend        = None
+    device         = None
+    last_channels  = None
+    trigger        = None
+    sampler        = None
     
-    def __init__(self, light_bus = 1, light_address = 0x29):
+    def __init__(self, light_bus = 1, light_address = 0x29, 
+                 backend = BACKEND_I2C, interrupt_pin = None, events = None):
         """ Initialize variables and set up display """
         self.light_bus      = light_bus
         self.light_address = light_address
+        self.backend        = backend
+        self.last_channels  = (0, 0)
         self._setup()
+        
+        if (interrupt_pin is not None) and (self.backend == BACKEND_I2C):
+            self._setup_interrupt(interrupt_pin, events)
     
     # End def
     
     
     def _setup(self):
         """Setup the hardware components."""
-        pass
+        if self.backend == BACKEND_SIMULATED:
+            return
+        
+        if self.backend != BACKEND_I2C:
+            raise ValueError("Unknown light sensor backend {0}".format(self.backend))
+        
+        try:
+            # Shared /dev/i2c-N only (i2cget cannot do burst reads); sensor
+            # reads go ahead of display refreshes
+            self.device = i2c_bus.open_shared(self.light_bus, self.light_address,
+                                              i2c_bus.PRIORITY_SENSOR)
+            
+            self.device.write([TSL2591_COMMAND | TSL2591_CONTROL_REG, TSL2591_CONTROL_VALUE])
+            self.device.write([TSL2591_COMMAND | TSL2591_ENABLE_REG, TSL2591_ENABLE_ON])
+        except (OSError, IOError) as error:
+            print("Could not set up light sensor ({0}); using simulated readings".format(error))
+            self.cleanup()
+            self.backend = BACKEND_SIMULATED
+
+    # End def
+
+
+    def _setup_interrupt(self, interrupt_pin, events):
+        """Interrupt (INT low) whenever the light is below LIGHT_THRESHOLD"""
+        if events is None:
+            events = gpio_events.default_events()
+        
+        low  = LIGHT_THRESHOLD
+        high = 0xFFFF
+        
+        self.device.write([TSL2591_COMMAND | TSL2591_AILTL_REG,
+                           low & 0xFF, low >> 8, high & 0xFF, high >> 8])
+        self.device.write([TSL2591_COMMAND | TSL2591_PERSIST_REG, TSL2591_PERSIST_EVERY])
+        self.device.write([TSL2591_COMMAND | TSL2591_ENABLE_REG, 
+                           TSL2591_ENABLE_ON | TSL2591_ENABLE_AIEN])
+        
+        self.trigger = events.watch(interrupt_pin, gpio_events.EDGE_FALLING, 
+                                    active_low=True)
+
+    # End def
+
+
+    def read_channels(self):
+        """Returns the (full spectrum, infrared) ADC counts
+        
+        Status and both channels are read in one transaction.  Until the 
+        first conversion is done (AVALID clear) the last reading is returned.
+        """
+        if self.backend == BACKEND_SIMULATED:
+            return (random.choice((0, 2 * LIGHT_THRESHOLD)), 0)
+        
+        data = self.device.write_read([TSL2591_COMMAND | TSL2591_STATUS_REG],
+                                      TSL2591_DATA_SIZE)
+        
+        if data[0] & TSL2591_STATUS_AVALID:
+            self.last_channels = (data[1] | (data[2] << 8), 
+                                  data[3] | (data[4] << 8))
+        
+        return self.last_channels
+    # End def
+
+
+    def start_sampling(self, rate = LIGHT_SAMPLE_RATE, **kwargs):
+        """Sample the sensor on a background thread; Returns the sampler"""
+        if self.sampler is None:
+            kwargs.setdefault("debounce", LIGHT_DEBOUNCE_SAMPLES)
+            
+            # on < off: the state turns on when the light drops
+            self.sampler = sensor_sampler.SensorSampler(
+                lambda: self.read_channels()[0], LIGHT_THRESHOLD, LIGHT_RELEASE,
+                rate = rate, **kwargs)
+            self.sampler.start()
+        
+        return self.sampler
 
     # End def
 
 
     def in_position(self):
         """Determines if the light sensor is activated (in position = no light) """
-        val = random.random()
-        if val > 0.5:
+        if self.sampler is not None:
+            if self.sampler.latest():
+                return 1
+            else:
+                return 0
+        
+        return self._read_position()
+    # End def
+
+
+    def _read_position(self):
+        """Reads the sensor once (unfiltered); Returns 1 if the light is blocked"""
+        if self.backend == BACKEND_SIMULATED:
+            val = random.random()
+            if val > 0.5:
+                return 1
+            else:
+                return 0
+        
+        if self.read_channels()[0] < LIGHT_THRESHOLD:
             return 1
         else:
             return 0
     # End def
 
 
+    def wait_for_card(self, timeout = None):
+        """Waits until a card blocks the light; Returns False on timeout"""
+        if self.trigger is None:
+            if self.sampler is not None:
+                return self.sampler.wait_for(True, timeout)
+            
+            return self._poll(True, timeout, self._read_position)
+        
+        # INT is latched: clear it, then check the light in case the card
+        # was already there
+        edge = self.trigger.next_edge()
+        self.device.write([TSL2591_CLEAR_INT])
+        
+        if self.in_position():
+            return True
+        
+        try:
+            edge.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return False
+        
+        return True
+
+    # End def
+
+
+    def wait_for_clear(self, timeout = None):
+        """Waits until the light is no longer blocked; Returns False on timeout
+        
+        Uses raw reads, not the sampler's filtered state, so the wait ends 
+        on the first conversion that sees light.
+        """
+        return self._poll(False, timeout, self._read_position)
+
+    # End def
+
+
+    def _poll(self, state, timeout, position):
+        """Wait until position() is state; Returns False on timeout
+        
+        position() is called every POLL_TIME.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        
+        while bool(position()) != state:
+            if (end is not None) and (time.monotonic() >= end):
+                return False
+            
+            time.sleep(POLL_TIME)
+        
+        return True
+
+    # End def
+
+
     def cleanup(self):
         """Cleanup the hardware components."""
-        pass
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        
+        if self.device is not None:
+            self.device.close()
+            self.device = None
         
     # End def
 
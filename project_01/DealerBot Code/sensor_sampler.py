@@ -0,0 +1,293 @@
+"""
+--------------------------------------------------------------------------
+Sensor Sampler
+--------------------------------------------------------------------------
+License:
+Copyright 2022 Abinand Parthasarathy
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its contributors
+may be used to endorse or promote products derived from this software without
+specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+--------------------------------------------------------------------------
+Software API:
+
+  SensorSampler(read, on, off=None, rate=SAMPLE_RATE, size=SAMPLE_WINDOW,
+                median=MEDIAN_SAMPLES, debounce=DEBOUNCE_SAMPLES)
+    - Calls read() at a fixed rate on its own thread and keeps the raw 
+      values in a preallocated ring buffer (array('d') of size samples)
+    - Each sample is filtered in three stages:
+        median   - median of the last median raw values (1 = off)
+        on / off - hysteresis thresholds; if on > off the state turns on 
+                   at or above on and off at or below off, if on < off it
+                   turns on at or below on (e.g. light falling when a card
+                   blocks it).  off defaults to on (no hysteresis).
+        debounce - the state only changes after debounce samples in a row
+                   agree
+    - Callers read the cached, filtered state, so they cost no bus time
+
+    start() / stop()
+      - Start / stop the sampling thread
+
+    latest()
+      - Filtered state (True / False) after the last sample
+
+    value
+      - Median filtered value of the last sample
+
+    wait_for(state, timeout=None)
+      - Wait until the filtered state is state; Returns False on timeout
+
+    stats(window=None)
+      - Returns {"count", "mean", "min", "max", "stdev", "rate", 
+        "changes", "overruns", "errors"} over the last window samples 
+        (default all samples in the ring buffer); rate is the measured
+        sample rate in Hz
+
+"""
+import math
+import time
+import threading
+from array import array
+
+
+# ------------------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------------------
+
+SAMPLE_RATE                 = 200               # Hz
+SAMPLE_WINDOW               = 256               # Samples kept for stats
+MEDIAN_SAMPLES              = 3
+DEBOUNCE_SAMPLES            = 2
+
+
+# ------------------------------------------------------------------------
+# Functions / Classes
+# ------------------------------------------------------------------------
+
+class SensorSampler():
+    """ Sample a sensor on a thread into a ring buffer; Filter it to a state """
+    read      = None
+    on        = None
+    off       = None
+    period    = None
+    median    = None
+    debounce  = None
+
+    samples   = None
+    times     = None
+    index     = 0
+    count     = 0
+    value     = None
+    state     = False
+    changes   = 0
+    overruns  = 0
+    errors    = 0
+    condition = None
+    cancel    = None
+    thread    = None
+
+    def __init__(self, read, on, off=None, rate=SAMPLE_RATE, size=SAMPLE_WINDOW,
+                 median=MEDIAN_SAMPLES, debounce=DEBOUNCE_SAMPLES):
+        """ Initialize class variables """
+        if rate <= 0:
+            raise ValueError("Sample rate must be greater than 0")
+
+        if (median < 1) or (median > size):
+            raise ValueError("Median must be between 1 and the window size")
+
+        if debounce < 1:
+            raise ValueError("Debounce must be at least 1 sample")
+
+        self.read      = read
+        self.on        = on
+        self.off       = on if off is None else off
+        self.period    = 1.0 / rate
+        self.median    = median
+        self.debounce  = debounce
+
+        # Preallocated ring buffer; index is the next slot to write
+        self.samples   = array('d', [0.0]) * size
+        self.times     = array('d', [0.0]) * size
+        self.index     = 0
+        self.count     = 0
+        self.value     = None
+        self.state     = False
+        self.changes   = 0
+        self.overruns  = 0
+        self.errors    = 0
+        self.condition = threading.Condition()
+        self.cancel    = threading.Event()
+        self.thread    = None
+
+    # End def
+
+    def start(self):
+        """ Start the sampling thread """
+        if self.thread is not None:
+            return
+
+        self.cancel.clear()
+
+        self.thread = threading.Thread(target=self._sample_loop, name="sensor-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # End def
+
+    def stop(self):
+        """ Stop the sampling thread """
+        if self.thread is None:
+            return
+
+        self.cancel.set()
+        self.thread.join()
+        self.thread = None
+
+    # End def
+
+    def latest(self):
+        """ Filtered state after the last sample """
+        return self.state
+
+    # End def
+
+    def wait_for(self, state, timeout=None):
+        """ Wait until the filtered state is state; Returns False on timeout """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.state == bool(state), timeout)
+
+    # End def
+
+    def stats(self, window=None):
+        """ Statistics of the last window raw samples """
+        with self.condition:
+            count = self.count if window is None else min(window, self.count)
+            size  = len(self.samples)
+            start = self.index - count
+            
+            values = [self.samples[(start + i) % size] for i in range(count)]
+            span   = 0.0
+            
+            if count > 1:
+                span = self.times[(self.index - 1) % size] - self.times[start % size]
+            
+            result = {"rate"     : (count - 1) / span if span > 0 else 0.0,
+                      "changes"  : self.changes,
+                      "overruns" : self.overruns,
+                      "errors"   : self.errors,
+                      "count"    : count}
+
+        if count == 0:
+            result.update({"mean": 0.0, "min": 0.0, "max": 0.0, "stdev": 0.0})
+            return result
+
+        mean = sum(values) / count
+
+        result.update({"mean"  : mean,
+                       "min"   : min(values),
+                       "max"   : max(values),
+                       "stdev" : math.sqrt(sum((v - mean) ** 2 for v in values) / count)})
+        return result
+
+    # End def
+
+    def _filter(self, value):
+        """ Returns the state the hysteresis thresholds give for value """
+        if self.on >= self.off:
+            if value >= self.on:
+                return True
+            if value <= self.off:
+                return False
+        else:
+            if value <= self.on:
+                return True
+            if value >= self.off:
+                return False
+
+        # Between the thresholds: keep the current state
+        return self.state
+
+    # End def
+
+    def _sample_loop(self):
+        """ Read the sensor at a fixed rate; Filter; Notify state changes """
+        size    = len(self.samples)
+        window  = array('d', [0.0]) * self.median
+        start   = time.monotonic()
+        tick    = 0
+        pending = self.state
+        agree   = 0
+
+        while True:
+            try:
+                raw = float(self.read())
+            except (OSError, IOError):
+                # A failed read is skipped; the state is left as it was
+                self.errors += 1
+                raw = None
+
+            if raw is not None:
+                now = time.monotonic()
+
+                with self.condition:
+                    self.samples[self.index] = raw
+                    self.times[self.index]   = now
+                    self.index = (self.index + 1) % size
+                    self.count = min(self.count + 1, size)
+
+                    # Median of the newest samples (fewer until filled)
+                    used = min(self.median, self.count)
+                    for i in range(used):
+                        window[i] = self.samples[(self.index - 1 - i) % size]
+                    
+                    self.value = sorted(window[:used])[used // 2]
+                    sample     = self._filter(self.value)
+
+                    # Debounce: the state changes after enough samples agree
+                    if sample == pending:
+                        agree += 1
+                    else:
+                        pending = sample
+                        agree   = 1
+
+                    if (agree >= self.debounce) and (pending != self.state):
+                        self.state    = pending
+                        self.changes += 1
+                        self.condition.notify_all()
+
+            tick += 1
+            delay = start + tick * self.period - time.monotonic()
+
+            if delay < 0:
+                # Fell behind: skip the missed ticks rather than bursting
+                self.overruns += 1
+                tick = int((time.monotonic() - start) / self.period) + 1
+                delay = start + tick * self.period - time.monotonic()
+
+            if self.cancel.wait(max(0.0, delay)):
+                break
+
+    # End def
+
+# End class